@@ -0,0 +1,267 @@
+"""
+Offline mode for backfilling a whole library through the OpenAI Batch API instead of one
+synchronous request per highlight (half the price, and no rate limits to fight with).
+
+    python batch_mode.py submit clean   # contexts of all highlights that were not cleaned yet
+    python batch_mode.py submit qa      # question-answer pairs of all cleaned highlights without any
+    python batch_mode.py collect [--wait]
+    python batch_mode.py status
+
+Every job is recorded in the state store before it is uploaded, so submitting and collecting can be
+interrupted at any point and simply be run again. Results are merged into the state store by highlight.
+"""
+import os
+import json
+import time
+import uuid
+import argparse
+from gpt_client import get_openai_client, call_with_retry
+from llm_cache import get_llm_cache, request_key
+from state_store import get_state_store
+from question_generation_pipeline import (
+    extract_highlights_from_clippings, find_book_file, locate_context_in_pdf, build_cleaning_messages,
+    load_page_offsets, save_page_offsets, CLEANING_MODEL, SUPPORTED_BOOK_FORMATS
+)
+from question_generation import build_qa_messages, QA_MODEL
+from highlight_dedup import deduplicate_highlights
+from config import CLIPPINGS_FILE_PATH, BATCH_DIRECTORY, BATCH_POLL_SECONDS
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW = "24h"
+# the batch API accepts at most 50,000 requests per batch
+MAX_REQUESTS_PER_BATCH = 50000
+FINISHED_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+KIND_CLEAN = "clean"
+KIND_QA = "qa"
+
+
+def _cleaning_requests(store):
+    """Yields (highlight, book, model, messages) for every highlight whose context was not cleaned yet."""
+    in_open_batches = store.highlights_in_open_batches(KIND_CLEAN)
+    highlights = extract_highlights_from_clippings(CLIPPINGS_FILE_PATH)
+    for book_title, book_highlights in highlights.items():
+        book_file_path = find_book_file(book_title)
+        if not book_file_path or not book_file_path.endswith(SUPPORTED_BOOK_FORMATS):
+            continue
+        book_title_without_bom = book_title.lstrip('\ufeff')
+        for entry in deduplicate_highlights(book_highlights, store.processed_highlights(book_title_without_bom)):
+            store.link_duplicate_highlights(book_title_without_bom, entry["highlight"], entry["duplicates"])
+            if entry["processed"]:
+                continue
+            highlight = entry["highlight"].replace("\n", "")
+            if highlight in in_open_batches or store.get_context(highlight) is not None:
+                continue
+            context = locate_context_in_pdf(book_file_path, highlight, entry["page_number"], book_title)
+            if context is None:
+                continue
+            yield highlight, book_title_without_bom, CLEANING_MODEL, build_cleaning_messages(context)
+    save_page_offsets(load_page_offsets())
+
+
+def _qa_requests(store):
+    """Yields (highlight, book, model, messages) for every cleaned highlight without question-answer pairs."""
+    in_open_batches = store.highlights_in_open_batches(KIND_QA)
+    for highlight, context in store.highlights_without_qa():
+        if highlight not in in_open_batches:
+            yield highlight, None, QA_MODEL, build_qa_messages(highlight, context)
+
+
+def _answer_from_cache(store, kind, requests):
+    """
+    Stores the results of requests the LLM response cache already has an answer for, and returns
+    only the requests that still have to be submitted.
+    """
+    cache = get_llm_cache()
+    remaining = []
+    for highlight, book, model, messages in requests:
+        cached_response = cache.get(request_key(model, messages))
+        if cached_response is None:
+            remaining.append((highlight, book, model, messages))
+        else:
+            _store_result(store, kind, highlight, book, cached_response)
+    if len(remaining) < len(requests):
+        print(f"Answered {len(requests) - len(remaining)} {kind} requests from the LLM response cache.")
+    return remaining
+
+
+def _store_result(store, kind, highlight, book, content):
+    if kind == KIND_CLEAN:
+        store.set_context(highlight, content)
+        if book:
+            store.add_processed_highlight(book, highlight)
+    else:
+        store.set_highlight_qa(highlight, content.strip())
+
+
+def _write_requests_file(job_id, kind, requests):
+    """Writes the batch input (one chat completion request per line) and returns its path and the request keys."""
+    os.makedirs(BATCH_DIRECTORY, exist_ok=True)
+    path = os.path.join(BATCH_DIRECTORY, f"{kind}-{job_id}.jsonl")
+    keys = []
+    with open(path, 'w', encoding='utf-8') as f:
+        for number, (highlight, book, model, messages) in enumerate(requests):
+            custom_id = f"{kind}-{number}"
+            f.write(json.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": BATCH_ENDPOINT,
+                "body": {"model": model, "messages": messages},
+            }) + "\n")
+            keys.append((custom_id, highlight, book))
+    return path, keys
+
+
+def _submit_job(store, job):
+    """Uploads the requests file of a recorded job and creates its batch, skipping whatever was already done."""
+    client = get_openai_client()
+    if not job["input_file_id"]:
+        with open(job["requests_file"], 'rb') as f:
+            requests_data = f.read()
+        input_file = call_with_retry(client.files.create, file=(os.path.basename(job["requests_file"]), requests_data), purpose="batch")
+        job["input_file_id"] = input_file.id
+        store.update_batch_job(job["job_id"], input_file_id=input_file.id, status="uploaded")
+    if not job["batch_id"]:
+        batch = call_with_retry(
+            client.batches.create, input_file_id=job["input_file_id"], endpoint=BATCH_ENDPOINT,
+            completion_window=BATCH_COMPLETION_WINDOW, metadata={"job_id": job["job_id"], "kind": job["kind"]}
+        )
+        job["batch_id"] = batch.id
+        store.update_batch_job(job["job_id"], batch_id=batch.id, status=batch.status)
+    print(f"Submitted {job['kind']} job {job['job_id']} as batch {job['batch_id']}")
+
+
+def resume_unsubmitted_jobs(store):
+    """Finishes submitting jobs an earlier run recorded but did not get to upload or create."""
+    for job in store.open_batch_jobs():
+        if not job["batch_id"]:
+            _submit_job(store, job)
+
+
+def submit(kind):
+    """
+    Writes the requests of every highlight that still needs the given kind of work into batch input
+    files and submits them.
+
+    Returns:
+        int: The number of requests that were submitted.
+    """
+    store = get_state_store()
+    resume_unsubmitted_jobs(store)
+
+    requests = list(_cleaning_requests(store) if kind == KIND_CLEAN else _qa_requests(store))
+    requests = _answer_from_cache(store, kind, requests)
+    if not requests:
+        print(f"Nothing to submit for {kind}.")
+        return 0
+
+    for start in range(0, len(requests), MAX_REQUESTS_PER_BATCH):
+        job_id = uuid.uuid4().hex
+        requests_file, keys = _write_requests_file(job_id, kind, requests[start:start + MAX_REQUESTS_PER_BATCH])
+        store.add_batch_job(job_id, kind, requests_file, keys)
+        _submit_job(store, {"job_id": job_id, "kind": kind, "requests_file": requests_file, "input_file_id": None, "batch_id": None})
+
+    print(f"Submitted {len(requests)} {kind} requests.")
+    return len(requests)
+
+
+def _request_cache_keys(requests_file):
+    """Returns {custom_id: LLM response cache key} of the requests in a batch input file."""
+    if not os.path.exists(requests_file):
+        return {}
+    keys = {}
+    with open(requests_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            request = json.loads(line)
+            body = dict(request["body"])
+            keys[request["custom_id"]] = request_key(body.pop("model"), body.pop("messages"), **body)
+    return keys
+
+
+def _merge_output(store, job, output):
+    """Merges the results of a finished batch into the state store. Safe to repeat."""
+    keys = store.batch_requests(job["job_id"])
+    request_keys = _request_cache_keys(job["requests_file"])
+    cache = get_llm_cache()
+    merged = failed = 0
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        key = keys.get(result.get("custom_id"))
+        response = result.get("response") or {}
+        if key is None or response.get("status_code") != 200:
+            failed += 1
+            continue
+        highlight, book = key
+        choice = response["body"]["choices"][0]
+        content = choice["message"].get("content")
+        # refusals and filtered responses come without any content (same rule as chat_completion_text)
+        if not content or not content.strip():
+            failed += 1
+            continue
+        # responses cut off by max_tokens are not replayed from the cache (same rule as chat_completion_text)
+        if result["custom_id"] in request_keys and choice.get("finish_reason") != "length":
+            cache.put(request_keys[result["custom_id"]], content)
+        _store_result(store, job["kind"], highlight, book, content)
+        merged += 1
+    return merged, failed
+
+
+def collect(wait=False):
+    """
+    Checks every open batch and merges the results of the finished ones into the state store.
+    With wait set, keeps polling until no batch is open anymore.
+    """
+    store = get_state_store()
+    client = get_openai_client()
+    resume_unsubmitted_jobs(store)
+
+    while True:
+        open_jobs = store.open_batch_jobs()
+        for job in open_jobs:
+            batch = call_with_retry(client.batches.retrieve, job["batch_id"])
+            store.update_batch_job(job["job_id"], status=batch.status, output_file_id=batch.output_file_id, error_file_id=batch.error_file_id)
+            if batch.status not in FINISHED_STATUSES:
+                print(f"Batch {job['batch_id']} ({job['kind']}) is {batch.status}")
+                continue
+
+            # expired and cancelled batches can still have results for part of their requests
+            merged = failed = 0
+            if batch.output_file_id:
+                output = call_with_retry(client.files.content, batch.output_file_id).text
+                merged, failed = _merge_output(store, job, output)
+            print(f"Batch {job['batch_id']} ({job['kind']}) is {batch.status}: merged {merged} results, {failed} failed")
+            # requests without a result are picked up again by the next submit
+            store.update_batch_job(job["job_id"], merged_at=time.strftime('%Y-%m-%d %H:%M:%S'))
+
+        if not wait or not store.open_batch_jobs():
+            return
+        time.sleep(BATCH_POLL_SECONDS)
+
+
+def status():
+    for job in get_state_store().open_batch_jobs():
+        print(f"{job['job_id']}  {job['kind']:<5}  batch {job['batch_id']}  {job['status']}  created {job['created_at']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    submit_parser = subparsers.add_parser("submit", help="submit the highlights that still need work")
+    submit_parser.add_argument("kind", choices=[KIND_CLEAN, KIND_QA])
+    collect_parser = subparsers.add_parser("collect", help="merge the results of finished batches")
+    collect_parser.add_argument("--wait", action="store_true", help=f"poll every {BATCH_POLL_SECONDS}s until all batches finished")
+    subparsers.add_parser("status", help="list the batches that were not collected yet")
+    args = parser.parse_args()
+
+    if args.command == "submit":
+        submit(args.kind)
+    elif args.command == "collect":
+        collect(args.wait)
+    else:
+        status()
+
+
+if __name__ == "__main__":
+    main()
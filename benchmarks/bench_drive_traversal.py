@@ -0,0 +1,89 @@
+"""
+Benchmarks the breadth first vault traversal against the depth first traversal (one list
+request per folder and page) the drive sync used before, on a fake drive with a fixed latency.
+
+Usage:
+    python benchmarks/bench_drive_traversal.py [--depth 3] [--folders-per-folder 6] [--notes-per-folder 5] [--latency 0.05]
+"""
+import os
+import sys
+import time
+import argparse
+
+# Add the parent directory to sys.path
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parent_dir)
+
+from benchmarks.fake_drive import FakeDriveService, FOLDER_MIME_TYPE
+from google_drive_sync.google_drive_sync_pipeline import traverse_obsidian_vault
+
+ROOT_ID = 'vault'
+
+
+def build_vault(drive, depth, folders_per_folder, notes_per_folder):
+    """Adds a vault of nested folders with a few notes each to the fake drive."""
+    level = [ROOT_ID]
+    drive.add(ROOT_ID, 'Obsidian Vault', mime_type=FOLDER_MIME_TYPE)
+    for _ in range(depth):
+        next_level = []
+        for folder_id in level:
+            for note in range(notes_per_folder):
+                drive.add(f'{folder_id}/note{note}', f'note{note}.md', folder_id)
+            for child in range(folders_per_folder):
+                child_id = f'{folder_id}/folder{child}'
+                drive.add(child_id, f'folder{child}', folder_id, mime_type=FOLDER_MIME_TYPE)
+                next_level.append(child_id)
+        level = next_level
+
+
+def legacy_traverse(service, folder_id, path=''):
+    """The depth first traversal the drive sync did before."""
+    results = []
+    page_token = None
+    while True:
+        response = service.files().list(
+            q=f"'{folder_id}' in parents and trashed=false",
+            spaces='drive',
+            fields='nextPageToken, files(id, name, mimeType, modifiedTime)',
+            pageToken=page_token
+        ).execute()
+        for file in response.get('files', []):
+            file_path = os.path.join(path, file['name'])
+            if file['mimeType'] == FOLDER_MIME_TYPE:
+                results.extend(legacy_traverse(service, file['id'], file_path))
+            else:
+                file['path'] = file_path
+                results.append(file)
+        page_token = response.get('nextPageToken', None)
+        if page_token is None:
+            break
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--folders-per-folder", type=int, default=6)
+    parser.add_argument("--notes-per-folder", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds every request takes")
+    args = parser.parse_args()
+
+    drive = FakeDriveService(latency=args.latency)
+    build_vault(drive, args.depth, args.folders_per_folder, args.notes_per_folder)
+    print(f"{len(drive.files_by_id)} files and folders, {args.latency * 1000:.0f} ms per request")
+
+    for name, traverse in (
+        ("legacy depth first", lambda: legacy_traverse(drive, ROOT_ID)),
+        ("breadth first, 1 thread", lambda: traverse_obsidian_vault(drive, ROOT_ID)),
+        ("breadth first, pool", lambda: traverse_obsidian_vault(drive, ROOT_ID, service_factory=lambda: drive)),
+    ):
+        drive.requests = 0
+        start = time.perf_counter()
+        files = traverse()
+        elapsed = time.perf_counter() - start
+        paths = sorted(file['path'] for file in files)
+        print(f"{name:<26} {elapsed:7.2f}s   {drive.requests:4d} requests   {len(paths)} notes")
+
+
+if __name__ == "__main__":
+    main()
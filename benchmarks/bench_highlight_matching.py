@@ -0,0 +1,104 @@
+"""
+Benchmarks the highlight matching engine against the fuzz.partial_ratio page scan
+extract_context_from_pdf used before.
+
+Highlights are sampled from the pdf itself (with a few characters dropped, like kindle drops
+ligatures), so both the time per highlight and whether the returned offset is right can be measured.
+
+Usage:
+    python benchmarks/bench_highlight_matching.py path/to/book.pdf [--highlights 50] [--seed 0]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+from fuzzywuzzy import fuzz as legacy_fuzz
+from fuzzywuzzy import process as legacy_process
+
+# Add the parent directory to sys.path
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parent_dir)
+
+from pdf_page_index import load_page_index
+from highlight_matching import find_highlight, release_ngram_index
+
+HIGHLIGHT_LENGTH = (60, 300)
+
+
+def sample_highlights(page_index, count, rng):
+    """Returns (page_idx, raw_start, highlight) tuples cut out of random pages of the book."""
+    pages = [page_idx for page_idx in range(len(page_index)) if len(page_index.raw_page(page_idx)) > HIGHLIGHT_LENGTH[1] * 2]
+    samples = []
+    for _ in range(count):
+        page_idx = rng.choice(pages)
+        page_text = page_index.raw_page(page_idx)
+        length = rng.randint(*HIGHLIGHT_LENGTH)
+        start = rng.randint(0, len(page_text) - length)
+        highlight = page_text[start:start + length]
+        # kindle drops some characters (eg: "field" in pdf -> "feld" in highlight)
+        for _ in range(length // 80):
+            drop = rng.randint(0, len(highlight) - 1)
+            highlight = highlight[:drop] + highlight[drop + 1:]
+        samples.append((page_idx, start, highlight))
+    return samples
+
+
+def legacy_match(page_index, highlight_text):
+    """The matching extract_context_from_pdf did before the matching engine."""
+    highlight_text = highlight_text.replace("\n", "")
+    for page_idx in range(len(page_index)):
+        page_text_cleaned = page_index.raw_page(page_idx).replace("\n", "").replace(" ", "").lower()
+        if page_text_cleaned and legacy_fuzz.partial_ratio(highlight_text.replace(" ", "").lower(), page_text_cleaned) > 80:
+            return page_idx, legacy_process.extractOne(highlight_text, [page_text_cleaned], scorer=legacy_fuzz.partial_ratio)[1]
+    return None, None
+
+
+def report(name, elapsed, found, correct, total):
+    print(f"{name:<28} {elapsed / total * 1000:9.1f} ms/highlight   found {found}/{total}   correct offset {correct}/{total}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("pdf")
+    parser.add_argument("--highlights", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--skip-legacy", action="store_true", help="only run the matching engine")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    page_index = load_page_index(args.pdf)
+    print(f"{len(page_index)} pages, page index loaded in {time.perf_counter() - start:.2f}s")
+
+    samples = sample_highlights(page_index, args.highlights, random.Random(args.seed))
+    total = len(samples)
+
+    # an offset counts as correct if it is within a few characters of where the highlight was cut out
+    def is_correct(page_idx, start, expected_page_idx, expected_start):
+        return page_idx == expected_page_idx and start is not None and abs(start - expected_start) <= 10
+
+    if not args.skip_legacy:
+        found = correct = 0
+        start = time.perf_counter()
+        for expected_page_idx, expected_start, highlight in samples:
+            page_idx, position = legacy_match(page_index, highlight)
+            found += page_idx == expected_page_idx
+            # the legacy "position" is really a score, so it is compared the same way the context was sliced
+            correct += is_correct(page_idx, position, expected_page_idx, expected_start)
+        report("legacy partial_ratio scan", time.perf_counter() - start, found, correct, total)
+
+    for name, with_page_number in (("engine, reported page", True), ("engine, no page number", False)):
+        release_ngram_index()
+        found = correct = 0
+        start = time.perf_counter()
+        for expected_page_idx, expected_start, highlight in samples:
+            # kindle page numbers start at 1
+            match = find_highlight(page_index, highlight, expected_page_idx + 1 if with_page_number else None, -1)
+            if match is not None:
+                found += match.page_index == expected_page_idx
+                correct += is_correct(match.page_index, match.start, expected_page_idx, expected_start)
+        report(name, time.perf_counter() - start, found, correct, total)
+
+
+if __name__ == "__main__":
+    main()
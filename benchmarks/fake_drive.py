@@ -0,0 +1,148 @@
+"""
+In-memory stand-in for the parts of the Google Drive v3 service the sync uses, with a fixed
+latency per request, so the drive sync can be run and timed without a Google account.
+"""
+import re
+import hashlib
+import time
+import threading
+import httplib2
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+
+class _Request:
+    def __init__(self, drive, handler):
+        self._drive = drive
+        self._handler = handler
+
+    def execute(self, *args, **kwargs):
+        with self._drive.lock:
+            self._drive.requests += 1
+        time.sleep(self._drive.latency)
+        return self._handler()
+
+
+class _MediaHttp:
+    """Answers the GET requests MediaIoBaseDownload sends with the whole content of a file."""
+
+    def __init__(self, drive, file_id):
+        self._drive = drive
+        self._file_id = file_id
+
+    def request(self, uri, method='GET', headers=None, **kwargs):
+        with self._drive.lock:
+            self._drive.requests += 1
+            self._drive.downloads += 1
+        time.sleep(self._drive.latency)
+        content = self._drive.contents[self._file_id]
+        return httplib2.Response({'status': 200, 'content-length': str(len(content))}), content
+
+
+class _MediaRequest:
+    def __init__(self, drive, file_id):
+        self.uri = f'https://fake.drive/{file_id}?alt=media'
+        self.headers = {}
+        self.http = _MediaHttp(drive, file_id)
+
+
+class _Files:
+    def __init__(self, drive):
+        self._drive = drive
+
+    def list(self, q='', pageSize=100, pageToken=None, **kwargs):
+        return _Request(self._drive, lambda: self._drive.query(q, pageSize, pageToken))
+
+    def get_media(self, fileId, **kwargs):
+        return _MediaRequest(self._drive, fileId)
+
+
+class _Changes:
+    def __init__(self, drive):
+        self._drive = drive
+
+    def getStartPageToken(self, **kwargs):
+        return _Request(self._drive, lambda: {'startPageToken': str(len(self._drive.change_log))})
+
+    def list(self, pageToken, pageSize=100, **kwargs):
+        return _Request(self._drive, lambda: self._drive.list_changes(pageToken, pageSize))
+
+
+class FakeDriveService:
+    """
+    Holds files as {id: {"id", "name", "mimeType", "parents", "modifiedTime", "md5Checksum", "size"}}
+    and their contents, answers files().list queries on parents, names and mime types, serves
+    files().get_media downloads, and records every change made through add/update/remove for
+    changes().list.
+    """
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.files_by_id = {}
+        self.contents = {}
+        self.change_log = []
+        self.requests = 0
+        self.downloads = 0
+        self.lock = threading.Lock()
+
+    def add(self, file_id, name, parent_id=None, mime_type='text/markdown', modified_time='2024-01-01T00:00:00.000Z', content=None):
+        self.files_by_id[file_id] = {
+            'id': file_id, 'name': name, 'mimeType': mime_type,
+            'parents': [parent_id] if parent_id else [], 'modifiedTime': modified_time,
+        }
+        if content is not None:
+            self._set_content(file_id, content)
+        self.change_log.append(file_id)
+        return self.files_by_id[file_id]
+
+    def _set_content(self, file_id, content):
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        self.contents[file_id] = content
+        self.files_by_id[file_id].update(md5Checksum=hashlib.md5(content).hexdigest(), size=str(len(content)))
+
+    def update(self, file_id, content=None, **fields):
+        """Renames (name=...), moves (parents=[...]) or edits (content=..., modifiedTime=...) a file."""
+        self.files_by_id[file_id].update(fields)
+        if content is not None:
+            self._set_content(file_id, content)
+        self.change_log.append(file_id)
+
+    def remove(self, file_id):
+        del self.files_by_id[file_id]
+        self.contents.pop(file_id, None)
+        self.change_log.append(file_id)
+
+    def files(self):
+        return _Files(self)
+
+    def changes(self):
+        return _Changes(self)
+
+    def list_changes(self, page_token, page_size):
+        start = int(page_token)
+        changes = []
+        for file_id in self.change_log[start:start + page_size]:
+            file = self.files_by_id.get(file_id)
+            changes.append({'fileId': file_id, 'removed': file is None, 'file': dict(file) if file else None})
+        if start + page_size < len(self.change_log):
+            return {'changes': changes, 'nextPageToken': str(start + page_size)}
+        return {'changes': changes, 'newStartPageToken': str(len(self.change_log))}
+
+    def _matches(self, file, q):
+        parents = re.findall(r"'([^']+)' in parents", q)
+        if parents and not set(parents).intersection(file['parents']):
+            return False
+        name = re.search(r"name='([^']*)'", q)
+        if name and file['name'] != name.group(1):
+            return False
+        mime_type = re.search(r"mimeType='([^']*)'", q)
+        return not mime_type or file['mimeType'] == mime_type.group(1)
+
+    def query(self, q, page_size, page_token):
+        matches = [dict(file) for file in self.files_by_id.values() if self._matches(file, q)]
+        start = int(page_token or 0)
+        response = {'files': matches[start:start + page_size]}
+        if start + page_size < len(matches):
+            response['nextPageToken'] = str(start + page_size)
+        return response
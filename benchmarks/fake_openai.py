@@ -0,0 +1,244 @@
+"""
+Local stand-in for the parts of the OpenAI API the pipelines use (chat completions, file uploads
+and downloads, and batches), with a fixed latency per request and optional rate limit / server
+errors, so the GPT stages can be run and timed without an API key. Point the pipelines at it with
+OPENAI_BASE_URL=http://127.0.0.1:<port>/v1 (any OPENAI_API_KEY works).
+
+Usage:
+    python benchmarks/fake_openai.py [--port 8765] [--latency 0.2] [--rate-limit-ratio 0.1] [--server-error-ratio 0.05]
+"""
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def echo_response(model, messages):
+    """The default answer of the fake server: the end of the last message, so responses differ per request."""
+    content = messages[-1]["content"] if messages else ""
+    if not isinstance(content, str):
+        content = json.dumps(content)
+    return f"Q: What does this say?\nA: {content[-200:]}"
+
+
+def chat_completion(model, messages, content, created=0):
+    # about 4 characters per token
+    prompt_tokens = sum(len(str(message["content"])) // 4 for message in messages)
+    completion_tokens = len(content) // 4
+    return {
+        "id": f"chatcmpl-{random.getrandbits(48):012x}", "object": "chat.completion", "created": created, "model": model,
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+    }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = "FakeOpenAI/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self._send_bytes(status, data, 'application/json', headers)
+
+    def _send_bytes(self, status, data, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, status, message, headers=None):
+        self._send_json(status, {"error": {"message": message, "type": "fake_error", "code": None}}, headers)
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def _injected_error(self):
+        """Answers with a rate limit or server error instead of the response (see FakeOpenAIServer); True if it did."""
+        server = self.server
+        draw = random.random()
+        if draw < server.rate_limit_ratio:
+            server.count("rate_limited")
+            self._send_error(429, "Rate limit reached (fake)", {'retry-after': str(server.retry_after)})
+            return True
+        if draw < server.rate_limit_ratio + server.server_error_ratio:
+            server.count("server_errors")
+            self._send_error(500, "Internal server error (fake)")
+            return True
+        return False
+
+    def do_POST(self):
+        server = self.server
+        body = self._read_body()
+        server.count("requests")
+        time.sleep(server.latency)
+        if self.path.endswith('/chat/completions'):
+            if self._injected_error():
+                return
+            request = json.loads(body)
+            server.count("chat_completions")
+            content = server.responder(request["model"], request["messages"])
+            self._send_json(200, chat_completion(request["model"], request["messages"], content, int(time.time())))
+        elif self.path.endswith('/files'):
+            filename, purpose, data = self._parse_upload(body)
+            self._send_json(200, server.add_file(filename, purpose, data))
+        elif self.path.endswith('/batches'):
+            request = json.loads(body)
+            if request["input_file_id"] not in server.files:
+                self._send_error(404, f"No such file: {request['input_file_id']}")
+                return
+            self._send_json(200, server.add_batch(request["input_file_id"], request["endpoint"], request.get("completion_window", "24h")))
+        else:
+            self._send_error(404, f"Unknown path: {self.path}")
+
+    def do_GET(self):
+        server = self.server
+        server.count("requests")
+        time.sleep(server.latency)
+        batch = re.search(r'/batches/([^/?]+)$', self.path)
+        content = re.search(r'/files/([^/?]+)/content$', self.path)
+        if batch:
+            found = server.retrieve_batch(batch.group(1))
+            if found is None:
+                self._send_error(404, f"No such batch: {batch.group(1)}")
+            else:
+                self._send_json(200, found)
+        elif content and content.group(1) in server.files:
+            self._send_bytes(200, server.files[content.group(1)]["data"], 'application/octet-stream')
+        else:
+            self._send_error(404, f"Unknown path: {self.path}")
+
+    def _parse_upload(self, body):
+        """Returns (filename, purpose, content) of a multipart/form-data file upload."""
+        message = BytesParser().parsebytes(f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode('utf-8') + body)
+        filename, purpose, data = "upload.jsonl", "batch", b""
+        for part in message.get_payload():
+            name = part.get_param('name', header='content-disposition')
+            if name == "file":
+                filename = part.get_filename() or filename
+                data = part.get_payload(decode=True)
+            elif name == "purpose":
+                purpose = part.get_payload(decode=True).decode('utf-8')
+        return filename, purpose, data
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    """
+    Serves /v1/chat/completions, /v1/files (upload and content) and /v1/batches (create and
+    retrieve). Chat completions are answered by responder(model, messages) -> content after
+    latency seconds; rate_limit_ratio and server_error_ratio of them fail with a 429 (with a
+    Retry-After of retry_after seconds) or a 500 instead. A batch completes once it was retrieved
+    batch_polls times, answering every request of its input file with the responder.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, responder=echo_response, rate_limit_ratio=0.0, server_error_ratio=0.0,
+                 retry_after=0.1, batch_polls=1):
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.latency = latency
+        self.responder = responder
+        self.rate_limit_ratio = rate_limit_ratio
+        self.server_error_ratio = server_error_ratio
+        self.retry_after = retry_after
+        self.batch_polls = batch_polls
+        self.files = {}
+        self.batches = {}
+        self.counts = {"requests": 0, "chat_completions": 0, "rate_limited": 0, "server_errors": 0}
+        self.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def add_file(self, filename, purpose, data):
+        with self.lock:
+            file_id = f"file-{len(self.files) + 1}"
+            self.files[file_id] = {"id": file_id, "object": "file", "bytes": len(data), "created_at": int(time.time()),
+                                   "filename": filename, "purpose": purpose, "status": "processed", "data": data}
+            return {key: value for key, value in self.files[file_id].items() if key != "data"}
+
+    def add_batch(self, input_file_id, endpoint, completion_window):
+        with self.lock:
+            batch_id = f"batch-{len(self.batches) + 1}"
+            self.batches[batch_id] = {
+                "id": batch_id, "object": "batch", "endpoint": endpoint, "input_file_id": input_file_id,
+                "completion_window": completion_window, "status": "in_progress", "created_at": int(time.time()),
+                "output_file_id": None, "error_file_id": None, "polls": 0,
+            }
+            return {key: value for key, value in self.batches[batch_id].items() if key != "polls"}
+
+    def retrieve_batch(self, batch_id):
+        with self.lock:
+            batch = self.batches.get(batch_id)
+            if batch is None:
+                return None
+            batch["polls"] += 1
+            run = batch["status"] == "in_progress" and batch["polls"] >= self.batch_polls
+        if run:
+            self._run_batch(batch)
+        return {key: value for key, value in batch.items() if key != "polls"}
+
+    def _run_batch(self, batch):
+        """Answers every request of the batch's input file and stores the output file."""
+        lines = []
+        for line in self.files[batch["input_file_id"]]["data"].decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            body = request["body"]
+            content = self.responder(body["model"], body["messages"])
+            response = {"status_code": 200, "request_id": f"req-{request['custom_id']}",
+                        "body": chat_completion(body["model"], body["messages"], content, int(time.time()))}
+            lines.append(json.dumps({"id": f"batch_req-{request['custom_id']}", "custom_id": request["custom_id"], "response": response, "error": None}))
+        output = self.add_file(f"{batch['id']}_output.jsonl", "batch_output", "\n".join(lines).encode('utf-8'))
+        with self.lock:
+            batch.update(status="completed", output_file_id=output["id"], completed_at=int(time.time()))
+
+    def start(self):
+        """Serves in a background thread (for use from a benchmark or test script)."""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True, name="fake-openai")
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs a fake OpenAI compatible server.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds every request takes")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0, help="ratio of chat completions answered with a 429")
+    parser.add_argument("--server-error-ratio", type=float, default=0.0, help="ratio of chat completions answered with a 500")
+    parser.add_argument("--batch-polls", type=int, default=1, help="retrieves before a batch completes")
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(args.port, args.latency, rate_limit_ratio=args.rate_limit_ratio,
+                              server_error_ratio=args.server_error_ratio, batch_polls=args.batch_polls)
+    print(f"Fake OpenAI server on {server.base_url} (set OPENAI_BASE_URL to it)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(server.counts)
+
+
+if __name__ == "__main__":
+    main()
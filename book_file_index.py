@@ -0,0 +1,128 @@
+import os
+import re
+import unicodedata
+from rapidfuzz import fuzz
+
+BOOK_EXTENSIONS = ('.epub', '.pdf')
+
+# share of the words of a book title (without the author and other parentheses at its end) that a file name
+# must contain for the file to count as the book
+MIN_TITLE_COVERAGE = 0.8
+
+
+def normalize_title(text):
+    """
+    Normalize a book title or file name for matching: no BOM, accents folded to ascii,
+    lowercase, and every run of non alphanumeric characters turned into a single space.
+    """
+    text = text.lstrip('\ufeff')
+    text = unicodedata.normalize('NFKD', text)
+    text = text.encode('ascii', 'ignore').decode('ascii')
+    return re.sub(r'[^a-z0-9]+', ' ', text.lower()).strip()
+
+
+def strip_trailing_parentheses(text):
+    """Removes the parentheses at the end of a title or file name, eg: "Title (Author)" -> "Title"."""
+    return re.sub(r'(\s*\([^()]*\))+\s*$', '', text) or text
+
+
+class BookFileIndex:
+    """
+    Index from normalized book titles to the book files of a directory.
+
+    Built once and only rebuilt when the directory's mtime changes (a file was added, removed or
+    renamed). Titles are looked up by exact normalized name first (with and without the parentheses
+    at their end, usually the author), then among the files containing most of the title's words,
+    ranked by how many of them they contain and by fuzzy similarity.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._mtime_ns = None
+        self._by_name = {}
+        self._token_postings = {}
+        self._names = []
+        self._lookups = {}
+
+    def _refresh_if_changed(self):
+        mtime_ns = os.stat(self.directory).st_mtime_ns
+        if mtime_ns == self._mtime_ns:
+            return
+        self._mtime_ns = mtime_ns
+        self._by_name = {}
+        self._token_postings = {}
+        self._names = []
+        self._lookups = {}
+
+        # when a book is there as both pdf and epub, the pdf is listed (and picked) first
+        for file in sorted(os.listdir(self.directory), key=lambda file: (os.path.splitext(file)[0], not file.lower().endswith('.pdf'))):
+            if not file.lower().endswith(BOOK_EXTENSIONS):
+                continue
+            stem = os.path.splitext(file)[0]
+            name = normalize_title(stem)
+            short_name = normalize_title(strip_trailing_parentheses(stem))
+            file_id = len(self._names)
+            self._names.append((short_name, os.path.join(self.directory, file)))
+            self._by_name.setdefault(name, file_id)
+            self._by_name.setdefault(short_name, file_id)
+            for token in set(name.split()):
+                self._token_postings.setdefault(token, []).append(file_id)
+
+    def _candidates(self, title_tokens):
+        """Returns the ids of the files that share the most selective title tokens."""
+        postings = sorted((self._token_postings[token] for token in title_tokens if token in self._token_postings), key=len)
+        if not postings:
+            return []
+        # files containing every known title token, or failing that the files sharing the rarest one
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            narrowed = candidates.intersection(posting)
+            if not narrowed:
+                break
+            candidates = narrowed
+        return candidates
+
+    def find(self, book_title):
+        """
+        Returns the path of the file of a book, or None if no file matches its title well enough.
+        """
+        self._refresh_if_changed()
+        title = normalize_title(book_title)
+        if not title:
+            return None
+        if title in self._lookups:
+            return self._lookups[title]
+
+        short_title = normalize_title(strip_trailing_parentheses(book_title)) or title
+        if title in self._by_name:
+            path = self._names[self._by_name[title]][1]
+        elif short_title in self._by_name:
+            path = self._names[self._by_name[short_title]][1]
+        else:
+            title_tokens = set(short_title.split())
+            best = None
+            for file_id in self._candidates(title_tokens):
+                name, candidate_path = self._names[file_id]
+                # a file named after a word or two of the title ("Algebra.pdf") is not the book
+                coverage = len(title_tokens.intersection(name.split())) / len(title_tokens)
+                if coverage < MIN_TITLE_COVERAGE:
+                    continue
+                # prefer the file with most of the title's words, then the closest name (extra words count against it),
+                # then the shorter (least decorated) file name, then the first listed
+                rank = (coverage, fuzz.token_sort_ratio(short_title, name), -len(name), -file_id)
+                if best is None or rank > best[0]:
+                    best = (rank, candidate_path)
+            path = best[1] if best else None
+
+        self._lookups[title] = path
+        return path
+
+
+_book_file_indexes = {}
+
+
+def get_book_file_index(directory):
+    """Returns the book file index of a directory, shared by everything in this process."""
+    if directory not in _book_file_indexes:
+        _book_file_indexes[directory] = BookFileIndex(directory)
+    return _book_file_indexes[directory]
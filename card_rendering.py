@@ -0,0 +1,416 @@
+import io
+import os
+import re
+import json
+import time
+import atexit
+import sqlite3
+import hashlib
+import functools
+import html
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from config import QUESTION_SETS_DIR, RENDER_CACHE_FILE, RENDER_CACHE_MAX_BYTES, RENDER_WORKERS
+
+# bump this whenever the rendering changes in a way the render settings do not capture, so cached cards are rendered again
+RENDER_VERSION = 1
+
+# how cards are rendered (part of the cache key of every card). tight_bbox crops the png to the text;
+# max_width_pixels (when set) lowers the dpi of cards that would be wider than that, so long answers stay small
+DEFAULT_RENDER_SETTINGS = {"figsize": [10, 10], "fontsize": 12, "dpi": 300, "pad_inches": 0.1, "tight_bbox": True, "max_width_pixels": None}
+
+# keys of a question set's config.json overriding the render settings of its cards
+SET_RENDER_SETTINGS = {"render_dpi": "dpi", "render_max_width_pixels": "max_width_pixels", "render_tight_bbox": "tight_bbox"}
+
+# how the cards of a question set are sent ("render_mode" in its config.json): as png images, or as html
+# with MathML (only the math that cannot be converted is sent as png images)
+RENDER_MODES = ("png", "html")
+
+# the math of a card: environments and $$...$$ / \[...\] are display math, $...$ and \(...\) inline math
+MATH_PATTERN = re.compile(
+    r'(\\begin\{(align\*|equation\*)\}.*?\\end\{\2\})'
+    r'|\$\$(.+?)\$\$|\\\[(.+?)\\\]|\\\((.+?)\\\)|(?<!\\)\$(.+?)(?<!\\)\$',
+    re.DOTALL
+)
+# latex2mathml keeps commands it does not know (and alignment outside of environments) as text
+UNCONVERTED_MATHML = re.compile(r'<mi>(\\|&</mi>)')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cards (
+    key TEXT PRIMARY KEY,
+    png BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cards_last_used ON cards (last_used);
+"""
+
+
+def card_latex(question, answer, keys_are_questions):
+    """The text of the card of a question: question and answer, or only the answer for sets whose keys are not questions."""
+    if keys_are_questions == "true":
+        return f"Question: {question}\n\nAnswer: {answer}"
+    return answer
+
+
+# Define custom LaTeX-like commands with a preceding space
+def custom_latex_commands(content):
+    content = re.sub(r'\\inner\{(.+?)\}\{(.+?)\}', r' \\langle \1, \2 \\rangle', content)
+    content = re.sub(r'\\norm\{(.+?)\}', r' \\|\1\\|', content)
+    content = re.sub(r'\\complex', r' \\mathbb{C}', content)
+    content = re.sub(r'\\reals', r' \\mathbb{R}', content)
+    content = re.sub(r'\\matrixset\{(.+?)\}\{(.+?)\}', r' M_{\1}(\2)', content)
+    return content
+
+
+# Handle LaTeX environments like align*, equation*, etc.
+def handle_environments(content):
+    # Convert \begin{align*}...\end{align*} to a display math environment
+    content = re.sub(
+        r'\\begin\{align\*\}(.*?)\\end\{align\*\}',
+        lambda m: f'\\[\n{m.group(1)}\n\\]',
+        content, flags=re.DOTALL
+    )
+    # Convert \begin{equation*}...\end{equation*} to a display math environment
+    content = re.sub(
+        r'\\begin\{equation\*\}(.*?)\\end\{equation\*\}',
+        lambda m: f'\\[\n{m.group(1)}\n\\]',
+        content, flags=re.DOTALL
+    )
+    return content
+
+
+def prepare_latex(latex_content):
+    """Turns the text of a card into what matplotlib renders."""
+    latex_content = custom_latex_commands(latex_content) # add custom commands
+    latex_content = handle_environments(latex_content)
+    # matplotlib breaks for some reason if there are double dollar signs
+    latex_content = re.sub(r'\$\$(.*?)\$\$', lambda m: f'\n${m.group(1)}$\n', latex_content, flags=re.DOTALL)
+    return latex_content
+
+
+# the figure cards are drawn on, created (and matplotlib imported) by the first card this process renders
+_figure = None
+
+
+def _get_figure():
+    global _figure
+    if _figure is None:
+        # the figure api draws without pyplot, so the figure is never registered with (or closed by) it
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        _figure = Figure()
+        FigureCanvasAgg(_figure)
+    return _figure
+
+
+@functools.lru_cache(maxsize=4096)
+def latex_to_mathml(latex, display):
+    """Returns the MathML of a LaTeX expression, or None if latex2mathml cannot convert it."""
+    import latex2mathml.converter
+
+    if display and ('&' in latex or '\\\\' in latex) and not latex.startswith('\\begin'):
+        latex = f'\\begin{{align*}}{latex}\\end{{align*}}'
+    try:
+        mathml = latex2mathml.converter.convert(latex, display="block" if display else "inline")
+    except Exception:
+        return None
+    if UNCONVERTED_MATHML.search(mathml):
+        return None
+    return mathml
+
+
+def render_markdown_latex(content, cid_prefix):
+    """
+    Turns the text of a card into html: markdown for the text and MathML for the math.
+
+    Args:
+        content (str): The text of the card
+        cid_prefix (str): Prefix of the content ids of the images standing in for math that cannot be converted
+
+    Returns:
+        tuple: (html, {content id: card text} of the math to attach as png images)
+    """
+    import markdown2
+
+    content = custom_latex_commands(content)
+    fragments = []
+
+    # math is taken out before markdown sees it, so its underscores and backslashes stay latex
+    def take_out_math(match):
+        fragments.append(match)
+        return f"MATHFRAGMENT{len(fragments) - 1}END"
+
+    html_content = markdown2.markdown(MATH_PATTERN.sub(take_out_math, content), safe_mode="escape")
+
+    fallback_images = {}
+
+    def put_back_math(match):
+        fragment = fragments[int(match.group(1))]
+        environment, display_dollars, display_brackets, inline_parens, inline_dollars = (
+            fragment.group(1), fragment.group(3), fragment.group(4), fragment.group(5), fragment.group(6)
+        )
+        display = inline_parens is None and inline_dollars is None
+        latex = next(part for part in (environment, display_dollars, display_brackets, inline_parens, inline_dollars) if part is not None)
+        mathml = latex_to_mathml(latex.strip(), display)
+        if mathml is not None:
+            return mathml
+        cid = f"{cid_prefix}{len(fallback_images)}"
+        fallback_images[cid] = environment if environment is not None else f"${latex}$"
+        return f'<img src="cid:{cid}" alt="{html.escape(fragment.group(0))}">'
+
+    html_content = re.sub(r'MATHFRAGMENT(\d+)END', put_back_math, html_content)
+    return html_content, fallback_images
+
+
+def render_latex_png(latex_content, settings=DEFAULT_RENDER_SETTINGS):
+    """Renders prepared card text into a png with matplotlib."""
+    figure = _get_figure()
+    figure.clear()
+    figure.set_size_inches(settings["figsize"])
+    axes = figure.add_subplot()
+    axes.axis('off')
+
+    axes.text(0.5, 0.5, latex_content, size=settings["fontsize"], ha='center', va='center', wrap=True)
+
+    bbox_inches = 'tight' if settings.get("tight_bbox", True) else None
+    dpi = settings["dpi"]
+    if settings.get("max_width_pixels"):
+        if bbox_inches == 'tight':
+            width = figure.get_tightbbox(figure.canvas.get_renderer()).width + 2 * settings["pad_inches"]
+        else:
+            width = figure.get_figwidth()
+        dpi = min(dpi, settings["max_width_pixels"] / width)
+
+    img_buffer = io.BytesIO()
+    figure.savefig(img_buffer, format='png', bbox_inches=bbox_inches, pad_inches=settings["pad_inches"], dpi=dpi)
+    return img_buffer.getvalue()
+
+
+def render_settings(set_config=None):
+    """The render settings of a question set's cards: the defaults with the overrides of its config.json."""
+    settings = dict(DEFAULT_RENDER_SETTINGS)
+    for config_key, setting in SET_RENDER_SETTINGS.items():
+        if set_config and config_key in set_config:
+            settings[setting] = parse_render_setting(setting, set_config[config_key])
+    return settings
+
+
+def parse_render_setting(setting, value):
+    """
+    Converts the value of a render setting in a question set's config.json, which may be written as a
+    string (set configs write booleans as "true" / "false", and numbers are often quoted too).
+    """
+    if setting == "tight_bbox":
+        return value.strip().lower() == "true" if isinstance(value, str) else bool(value)
+    if value is None or value == "":
+        # only max_width_pixels is optional; a missing dpi falls back to the default
+        return DEFAULT_RENDER_SETTINGS[setting]
+    return int(value)
+
+
+def card_key(latex_content, settings):
+    """Cache key of a card: a hash of its prepared text and everything that changes how it is rendered."""
+    card = {"latex": latex_content, "settings": settings, "version": RENDER_VERSION}
+    return hashlib.sha256(json.dumps(card, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class RenderedCardCache:
+    """
+    On-disk cache of rendered cards (png bytes) keyed by card_key, evicting the least recently
+    used cards once they take more than max_bytes.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+
+    def get(self, key):
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT png FROM cards WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE cards SET last_used = ? WHERE key = ?", (time.time(), key))
+            return bytes(row[0])
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM cards WHERE key = ?", (key,)).fetchone() is not None
+
+    def put(self, key, png):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO cards (key, png, size, last_used) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET png = excluded.png, size = excluded.size, last_used = excluded.last_used",
+                (key, png, len(png), time.time())
+            )
+            self._evict()
+
+    def _evict(self):
+        """Deletes the least recently used cards until the cache fits into max_bytes."""
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM cards").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._conn.execute("SELECT key, size FROM cards ORDER BY last_used").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM cards WHERE key = ?", (key,))
+            total -= size
+
+    def print_stats(self):
+        if self.hits or self.misses:
+            print(f"Rendered card cache: {self.hits} hits, {self.misses} misses this run")
+
+
+_render_cache = None
+_render_cache_lock = threading.Lock()
+
+
+def get_render_cache():
+    """Returns the rendered card cache shared by this process."""
+    global _render_cache
+    with _render_cache_lock:
+        if _render_cache is None:
+            _render_cache = RenderedCardCache(RENDER_CACHE_FILE, RENDER_CACHE_MAX_BYTES)
+            atexit.register(_render_cache.print_stats)
+        return _render_cache
+
+
+def _warm_up_render_worker():
+    """Imports matplotlib and renders a card once, so the worker's first real card does not pay for it."""
+    render_latex_png("$x$", DEFAULT_RENDER_SETTINGS)
+
+
+def _render_card(latex_content, settings):
+    try:
+        return render_latex_png(latex_content, settings), None
+    except Exception as e:
+        return None, str(e)
+
+
+class CardRenderer:
+    """
+    Renders cards, taking the ones rendered before from the rendered card cache. The others are
+    rendered by a pool of worker processes, each importing matplotlib once and drawing every card
+    on the same figure; the pool is started by the first batch with more than one card to render
+    and kept until shutdown.
+    """
+
+    def __init__(self, max_workers=RENDER_WORKERS):
+        self.max_workers = max_workers
+        self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            # spawned, not forked: the callers run threads (GPT requests) and hold sqlite connections
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_warm_up_render_worker
+            )
+        return self._pool
+
+    def render(self, cards):
+        """
+        Args:
+            cards (list): (card text, render settings) of the cards to render
+
+        Returns:
+            list: The png of every card, in order, or None for the cards matplotlib failed to render
+        """
+        cache = get_render_cache()
+        prepared = [(prepare_latex(latex_content), settings) for latex_content, settings in cards]
+        keys = [card_key(latex_content, settings) for latex_content, settings in prepared]
+        pngs = {}
+        missing = {}
+        for key, card in zip(keys, prepared):
+            if key in pngs or key in missing:
+                continue
+            png = cache.get(key)
+            if png is None:
+                missing[key] = card
+            else:
+                pngs[key] = png
+
+        if len(missing) <= 1 or self.max_workers <= 1:
+            rendered = (_render_card(*card) for card in missing.values())
+        else:
+            pool = self._get_pool()
+            rendered = [future.result() for future in [pool.submit(_render_card, *card) for card in missing.values()]]
+        for key, (png, error) in zip(list(missing), rendered):
+            if png is None:
+                print(f"Failed to render card: {missing[key][0][:80]!r}. Error: {error}")
+                continue
+            cache.put(key, png)
+            pngs[key] = png
+        return [pngs.get(key) for key in keys]
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+
+_card_renderer = None
+
+
+def get_card_renderer():
+    """Returns the card renderer shared by this process (its workers are stopped at exit)."""
+    global _card_renderer
+    if _card_renderer is None:
+        _card_renderer = CardRenderer()
+        atexit.register(_card_renderer.shutdown)
+    return _card_renderer
+
+
+def latex_to_image(latex_content, settings=DEFAULT_RENDER_SETTINGS):
+    """
+    Returns the png of a card (None if it cannot be rendered), from the rendered card cache if
+    the same text was rendered with the same settings before.
+    """
+    return get_card_renderer().render([(latex_content, settings)])[0]
+
+
+def load_set_config(question_set):
+    """Returns the config.json of a question set, or None if the set has none yet."""
+    config_path = os.path.join(QUESTION_SETS_DIR, question_set, "config.json")
+    if not os.path.exists(config_path):
+        return None
+    with open(config_path, 'r') as config_file:
+        return json.load(config_file)
+
+
+def precompute_cards(question_set, qa_pairs):
+    """
+    Renders the cards of new QA pairs into the rendered card cache, so that sending them later is
+    only a cache lookup. Cards that fail to render are rendered (or shown as text) again when sent.
+
+    Returns:
+        int: The number of cards that are in the cache now.
+    """
+    set_config = load_set_config(question_set) or {}
+    # new sets get the config of create_set.sh, where the keys are questions
+    keys_are_questions = set_config.get("keys_are_question", "true")
+    settings = render_settings(set_config)
+    cards = [(card_latex(question, answer, keys_are_questions), settings) for question, answer in qa_pairs.items()]
+    if set_config.get("render_mode", "png") == "html":
+        # only the math that cannot be sent as MathML is rendered
+        cards = [(latex, settings) for latex_content, _ in cards for latex in render_markdown_latex(latex_content, "")[1].values()]
+    return sum(png is not None for png in get_card_renderer().render(cards))
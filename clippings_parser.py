@@ -0,0 +1,106 @@
+import os
+import re
+import hashlib
+
+# kindle ends every entry of My Clippings.txt with this line
+CLIPPINGS_SEPARATOR = b"=========="
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def iter_clippings(clippings_file, start_offset=0):
+    """
+    Lazily yields the entries of a clippings file, starting at a byte offset.
+
+    Only entries followed by a separator are yielded; kindle appends the separator right after
+    an entry, so anything after the last separator is an entry that is still being written.
+
+    Args:
+        clippings_file (str): The path to My Clippings.txt
+        start_offset (int): The byte offset to start reading at (the end of an entry read earlier)
+
+    Returns:
+        generator: (entry_bytes, start_offset, end_offset) of every entry, where end_offset is just
+        after the entry's separator.
+    """
+    with open(clippings_file, 'rb') as file:
+        file.seek(start_offset)
+        buffer = b""
+        buffer_start = start_offset
+        while True:
+            chunk = file.read(READ_CHUNK_SIZE)
+            if not chunk:
+                return
+            buffer += chunk
+            while True:
+                separator_index = buffer.find(CLIPPINGS_SEPARATOR)
+                if separator_index == -1:
+                    break
+                end_offset = buffer_start + separator_index + len(CLIPPINGS_SEPARATOR)
+                yield buffer[:separator_index], buffer_start, end_offset
+                buffer = buffer[separator_index + len(CLIPPINGS_SEPARATOR):]
+                buffer_start = end_offset
+
+
+def parse_clipping(entry):
+    """
+    Parses one entry of a clippings file.
+
+    Returns:
+        tuple: (book_title, highlight, page_number), or None if the entry is not a highlight.
+    """
+    lines = entry.decode('utf-8', errors='replace').strip().split('\n')
+    if len(lines) < 3:
+        return None
+
+    # Skip entries that are not highlights
+    if "Note" in lines[1] or "Bookmark" in lines[1]:
+        return None
+
+    book_title = lines[0].strip()
+    highlight = lines[-1].strip()
+
+    # Extract page number if available
+    page_number = None
+    for line in lines:
+        if "Your Highlight on page" in line:
+            # Extract page number(s) from the line
+            page_number_match = re.search(r'page\s+(\d+)(?:-\d+)?', line)
+            if page_number_match:
+                page_number = int(page_number_match.group(1))
+            break
+
+    return book_title, highlight, page_number
+
+
+def _entry_hash(entry):
+    return hashlib.sha256(entry).hexdigest()
+
+
+def watermark_start_offset(clippings_file, watermark):
+    """
+    Returns the byte offset new entries start at, or 0 if the file has to be read from the start
+    because there is no watermark yet or the file was truncated or rewritten since it was taken.
+    """
+    if not watermark or watermark.get("path") != os.path.abspath(clippings_file):
+        return 0
+    start, end = watermark["last_entry_start"], watermark["offset"]
+    if os.path.getsize(clippings_file) < end:
+        print("Clippings file is smaller than at the last run. Rescanning it.")
+        return 0
+    with open(clippings_file, 'rb') as file:
+        file.seek(start)
+        last_entry = file.read(end - start)
+    if not last_entry.endswith(CLIPPINGS_SEPARATOR) or _entry_hash(last_entry[:-len(CLIPPINGS_SEPARATOR)]) != watermark["last_entry_hash"]:
+        print("Clippings file was rewritten since the last run. Rescanning it.")
+        return 0
+    return end
+
+
+def make_watermark(clippings_file, entry, entry_start, entry_end):
+    """Watermark pointing just after an entry, with the hash needed to check the file was not rewritten."""
+    return {
+        "path": os.path.abspath(clippings_file),
+        "offset": entry_end,
+        "last_entry_start": entry_start,
+        "last_entry_hash": _entry_hash(entry),
+    }
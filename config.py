@@ -17,4 +17,65 @@ PROCESSED_TEXT_FILE = "/home/viloh/Documents/kindle_pdf_highlights/temp/processe
 QUESTION_SETS_DIR = "/home/viloh/Documents/kindle_pdf_highlights/question_sets"
 
 # the characters around the highlighted text that are used to provide context for gpt to generate the question
-HIGHLIGHT_CONTEXT_CHARACTER_WINDOW = 2000
\ No newline at end of file
+HIGHLIGHT_CONTEXT_CHARACTER_WINDOW = 2000
+# directory where the extracted text of every book is stored, so each book is only parsed once
+PAGE_INDEX_DIRECTORY = "/home/viloh/Documents/kindle_pdf_highlights/page_index"
+
+# learned offsets between the page numbers kindle reports and the page indices of each pdf
+PAGE_OFFSETS_FILE = "/home/viloh/Documents/kindle_pdf_highlights/page_offsets.json"
+
+# the learned page offsets are kept in memory and only written back after this many changes / seconds
+# (and when the run ends); everything else is written to the state database right away
+STATE_FLUSH_EVERY = 20
+STATE_FLUSH_SECONDS = 30
+
+# sqlite database holding processed highlights, highlight contexts, generated QA pairs and when questions were sent.
+# The json files above are only read once to import them into it (question set QA files again whenever they are edited)
+STATE_DB_FILE = "/home/viloh/Documents/kindle_pdf_highlights/state.sqlite3"
+
+# OpenAI requests. OPENAI_BASE_URL can point the pipelines at any OpenAI compatible server (eg: a local fake one for testing)
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
+GPT_MAX_CONCURRENCY = 4  # requests in flight at the same time
+GPT_REQUESTS_PER_MINUTE = 500
+GPT_TOKENS_PER_MINUTE = 200000
+GPT_MAX_RETRIES = 5  # retries of rate limited (429) and failed (5xx) requests
+
+# OpenAI batch mode: request files are written here, and open batches are polled every BATCH_POLL_SECONDS when waiting
+BATCH_DIRECTORY = "/home/viloh/Documents/kindle_pdf_highlights/batches"
+BATCH_POLL_SECONDS = 60
+
+# responses of identical LLM requests (same model, prompt, content and parameters) are reused from this cache.
+# The least recently used responses are evicted once it grows over LLM_CACHE_MAX_BYTES
+LLM_CACHE_FILE = "/home/viloh/Documents/kindle_pdf_highlights/llm_cache.sqlite3"
+LLM_CACHE_MAX_BYTES = 200 * 1024 * 1024
+
+# number of processes finding the highlights of different books in their pdfs at the same time (1 finds them in the main process)
+EXTRACTION_WORKERS = os.cpu_count() or 1
+
+# google drive requests (folder listings and downloads) running at the same time during a sync
+DRIVE_MAX_CONCURRENCY = 8
+
+# images of the obsidian vault downloaded from google drive, stored by their md5 checksum
+IMAGE_CACHE_DIRECTORY = "/home/viloh/Documents/kindle_pdf_highlights/image_cache"
+# notes of a google drive sync that are downloaded or waiting for / in a GPT request at the same time.
+# Downloads pause while this many notes are in flight, so they cannot run far ahead of the (slower) GPT requests
+DRIVE_NOTES_IN_FLIGHT = 16
+
+# lock files serializing the writes to and reads of each question set across processes (drive sync and emailer)
+QUESTION_SET_LOCK_DIRECTORY = "/home/viloh/Documents/kindle_pdf_highlights/locks"
+
+# rendered question cards of the email digests, by a hash of their text and render settings.
+# The least recently used cards are evicted once they take more than RENDER_CACHE_MAX_BYTES
+RENDER_CACHE_FILE = "/home/viloh/Documents/kindle_pdf_highlights/render_cache.sqlite3"
+RENDER_CACHE_MAX_BYTES = 100 * 1024 * 1024
+
+# number of processes rendering the cards that are not in the render cache (1 renders them in the main process)
+RENDER_WORKERS = os.cpu_count() or 1
+
+# SMTP server the emails are sent through (the sender, receiver and password are in .env).
+# SMTP_HOST, SMTP_PORT and SMTP_SSL=false can point the emails at a local test server (eg: python -m aiosmtpd -n)
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "465"))
+SMTP_SSL = os.getenv("SMTP_SSL", "true") == "true"  # false: plain SMTP, upgraded with STARTTLS when the server offers it
+SMTP_TIMEOUT_SECONDS = 30
+SMTP_MAX_RETRIES = 3  # retries of emails that failed with a connection problem or a temporary (4xx) error
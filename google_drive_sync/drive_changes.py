@@ -0,0 +1,94 @@
+from google_drive_sync.drive_traversal import FILE_FIELDS, FOLDER_MIME_TYPE
+
+CHANGES_PAGE_SIZE = 1000
+
+
+def get_start_page_token(service):
+    """Returns the page token drive's changes start at right now."""
+    return service.changes().getStartPageToken().execute()['startPageToken']
+
+
+def list_changes(service, page_token):
+    """
+    Lists every change drive recorded since the page token was taken.
+
+    Returns:
+        tuple: (changes, page_token to list the changes after these from)
+    """
+    changes = []
+    while True:
+        response = service.changes().list(
+            pageToken=page_token,
+            spaces='drive',
+            includeRemoved=True,
+            pageSize=CHANGES_PAGE_SIZE,
+            fields=f'nextPageToken, newStartPageToken, changes(fileId, removed, file({FILE_FIELDS}, trashed))'
+        ).execute()
+        changes.extend(response.get('changes', []))
+        if 'newStartPageToken' in response:
+            return changes, response['newStartPageToken']
+        page_token = response['nextPageToken']
+
+
+def _reachable(nodes, root_id):
+    """Returns the ids of the nodes that are below the root folder (through folders that are too)."""
+    reachable = {root_id: True}
+
+    def is_reachable(node_id, visiting):
+        if node_id not in reachable:
+            node = nodes.get(node_id)
+            # a folder that is its own ancestor (drive does not allow it, but be safe) is not reachable
+            if node is None or node_id in visiting:
+                return False
+            visiting.add(node_id)
+            reachable[node_id] = any(
+                is_reachable(parent, visiting) and (parent == root_id or nodes[parent]['mimeType'] == FOLDER_MIME_TYPE)
+                for parent in node.get('parents', [])
+            )
+        return reachable[node_id]
+
+    return {node_id for node_id in nodes if is_reachable(node_id, set())}
+
+
+def apply_changes(nodes, root_id, changes):
+    """
+    Applies drive changes to the cached files and folders below a root folder: new and edited
+    files are added, renamed and moved ones updated, and deleted or trashed ones (and everything
+    that was in a deleted folder, or moved out of the tree) removed.
+
+    Args:
+        nodes (dict): {id: file} of every file and folder below the root folder, as of the changes' page token
+        root_id (str): The id of the root folder
+        changes (list): The changes returned by list_changes
+
+    Returns:
+        tuple: ({id: file} below the root folder after the changes,
+                ids of the non-folder files that changed and are still below the root folder,
+                ids of the nodes that are not below the root folder anymore)
+    """
+    updated = dict(nodes)
+    changed_ids = set()
+    for change in changes:
+        file = change.get('file')
+        if change.get('removed') or file is None or file.get('trashed'):
+            updated.pop(change['fileId'], None)
+            continue
+        updated[file['id']] = {key: value for key, value in file.items() if key != 'trashed'}
+        if file['mimeType'] != FOLDER_MIME_TYPE:
+            changed_ids.add(file['id'])
+
+    # drops whatever was never below the root folder, and what no longer is
+    reachable = _reachable(updated, root_id)
+    updated = {node_id: node for node_id, node in updated.items() if node_id in reachable}
+    removed_ids = set(nodes) - set(updated)
+    return updated, changed_ids & reachable, removed_ids
+
+
+def entered_folders(previous_nodes, nodes):
+    """
+    Returns the ids of the folders that are below the root folder after the changes but were not
+    before (moved in, or restored from the trash), leaving out those inside another one of them.
+    Drive only reports the folder itself, not the unchanged files and folders in it.
+    """
+    entered = {node_id for node_id, node in nodes.items() if node['mimeType'] == FOLDER_MIME_TYPE and node_id not in previous_nodes}
+    return {node_id for node_id in entered if not any(parent in entered for parent in nodes[node_id].get('parents', []))}
@@ -0,0 +1,116 @@
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from googleapiclient.http import MediaIoBaseDownload
+from config import DRIVE_MAX_CONCURRENCY
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+# folders listed by a single files().list query ('a' in parents or 'b' in parents or ...);
+# drive rejects queries that get too long
+PARENTS_PER_QUERY = 20
+LIST_PAGE_SIZE = 1000
+FILE_FIELDS = 'id, name, mimeType, modifiedTime, md5Checksum, size, parents'
+
+
+class DriveServicePool:
+    """
+    Hands every thread its own drive service: the services built by googleapiclient share one
+    http connection and must not be used by several threads at once.
+    """
+
+    def __init__(self, service_factory):
+        self._service_factory = service_factory
+        self._local = threading.local()
+
+    def get(self):
+        if not hasattr(self._local, 'service'):
+            self._local.service = self._service_factory()
+        return self._local.service
+
+
+def download_file(service, file_id):
+    """Returns the content of a drive file as bytes."""
+    request = service.files().get_media(fileId=file_id)
+    fh = io.BytesIO()
+    downloader = MediaIoBaseDownload(fh, request)
+    done = False
+    while done is False:
+        status, done = downloader.next_chunk()
+    return fh.getvalue()
+
+
+def list_children(service, folder_ids, fields=FILE_FIELDS):
+    """
+    Lists the children (files and folders, not trashed) of several folders with one query,
+    following every page of the result.
+    """
+    parents = " or ".join(f"'{folder_id}' in parents" for folder_id in folder_ids)
+    children = []
+    page_token = None
+    while True:
+        response = service.files().list(
+            q=f"({parents}) and trashed=false",
+            spaces='drive',
+            fields=f'nextPageToken, files({fields})',
+            pageSize=LIST_PAGE_SIZE,
+            pageToken=page_token
+        ).execute()
+        children.extend(response.get('files', []))
+        page_token = response.get('nextPageToken', None)
+        if page_token is None:
+            return children
+
+
+def walk_folder_tree(service_factory, root_id, max_workers=DRIVE_MAX_CONCURRENCY):
+    """
+    Lists everything below a folder breadth first. The folders of each level are listed
+    PARENTS_PER_QUERY at a time, with up to max_workers queries running at the same time,
+    so a vault takes about one round trip per level instead of one per folder.
+
+    Args:
+        service_factory (callable): Returns a drive service (called once per worker thread)
+        root_id (str): The id of the folder to walk
+        max_workers (int): The number of list queries running at the same time
+
+    Returns:
+        dict: {id: file} of every file and folder below the root folder
+    """
+    services = DriveServicePool(service_factory)
+    nodes = {}
+    level = [root_id]
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="drive") as pool:
+        while level:
+            chunks = [level[start:start + PARENTS_PER_QUERY] for start in range(0, len(level), PARENTS_PER_QUERY)]
+            next_level = []
+            for children in pool.map(lambda chunk: list_children(services.get(), chunk), chunks):
+                for child in children:
+                    # a file with several parents inside the vault is only listed once
+                    if child['id'] in nodes or child['id'] == root_id:
+                        continue
+                    nodes[child['id']] = child
+                    if child['mimeType'] == FOLDER_MIME_TYPE:
+                        next_level.append(child['id'])
+            level = next_level
+    return nodes
+
+
+def rebuild_paths(nodes, root_id):
+    """
+    Returns {id: path} of every node, its path being the names of the folders between the root
+    folder and the node (and the node's own name) joined like os.path.join.
+    """
+    paths = {root_id: ''}
+
+    def path_of(node_id):
+        if node_id not in paths:
+            node = nodes[node_id]
+            parent_id = next((parent for parent in node.get('parents', []) if parent == root_id or parent in nodes), root_id)
+            paths[node_id] = os.path.join(path_of(parent_id), node['name'])
+        return paths[node_id]
+
+    for node_id in nodes:
+        path_of(node_id)
+    del paths[root_id]
+    return paths
@@ -4,7 +4,11 @@ import io
 import json
 import re
 import base64
+import hashlib
+import argparse
 from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseDownload
@@ -19,6 +23,14 @@ parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(parent_dir)
 
 from gpt_prompts.qa_generation import generate_qa_pairs
+from state_store import get_state_store
+from question_set_lock import question_set_lock
+from config import DRIVE_MAX_CONCURRENCY, DRIVE_NOTES_IN_FLIGHT
+from gpt_client import GPTWorkerPool
+from card_rendering import precompute_cards
+from google_drive_sync.drive_traversal import FOLDER_MIME_TYPE, DriveServicePool, walk_folder_tree, rebuild_paths, download_file
+from google_drive_sync.image_index import find_image_references, build_image_index, load_images
+from google_drive_sync.drive_changes import get_start_page_token, list_changes, apply_changes, entered_folders
 
 # Define absolute paths
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -35,6 +47,12 @@ AUTH_PORT = os.getenv('AUTH_PORT', 5879)
 # Add these new constants
 RELEVANT_FOLDERS = ['machine_learning']
 
+# drive changes page token of the last sync, and the vault the cached file tree belongs to
+DRIVE_PAGE_TOKEN_KEY = 'drive_changes_page_token'
+DRIVE_VAULT_ID_KEY = 'drive_vault_id'
+# set once a sync completed with the manifest: from then on, a note without a manifest entry was never processed
+DRIVE_MANIFEST_MIGRATED_KEY = 'drive_manifest_migrated'
+
 # Function to handle authentication and store token.json
 def authenticate():
     creds = None
@@ -71,10 +89,17 @@ def authenticate():
 
 # Function to get Google Drive service
 def get_drive_service():
+    service_factory = get_drive_service_factory()
+    if service_factory is None:
+        return None
+    return service_factory()
+
+# Returns a function building Google Drive services (one per thread, as they are not thread safe)
+def get_drive_service_factory():
     creds = authenticate()
     if creds is None:
         return None
-    return build('drive', 'v3', credentials=creds)
+    return lambda: build('drive', 'v3', credentials=creds, cache_discovery=False)
 
 # Function to find the Obsidian Vault folder ID
 def find_obsidian_vault_id(service, folder_name='Obsidian Vault'):
@@ -89,73 +114,87 @@ def find_obsidian_vault_id(service, folder_name='Obsidian Vault'):
     return items[0]['id']
 
 # Traverse the Obsidian Vault directory
-def traverse_obsidian_vault(service, folder_id, path='', parent_name=''):
+# The folders are listed level by level, several folders per request and several requests at a time
+# (pass service_factory to list with more than one thread)
+def traverse_obsidian_vault(service, folder_id, path='', parent_name='', service_factory=None):
+    if service_factory is None:
+        nodes = walk_folder_tree(lambda: service, folder_id, max_workers=1)
+    else:
+        nodes = walk_folder_tree(service_factory, folder_id)
+    return vault_files(nodes, folder_id, path)
+
+# The files (not folders) of a listed vault, with their paths in the vault
+def vault_files(nodes, folder_id, path=''):
+    paths = rebuild_paths(nodes, folder_id)
+
     results = []
-    page_token = None
-    while True:
-        response = service.files().list(
-            q=f"'{folder_id}' in parents and trashed=false",
-            spaces='drive',
-            fields='nextPageToken, files(id, name, mimeType, modifiedTime)',
-            pageToken=page_token
-        ).execute()
-        for file in response.get('files', []):
-            file_path = os.path.join(path, file['name'])
-            if file['mimeType'] == 'application/vnd.google-apps.folder':
-                results.extend(traverse_obsidian_vault(service, file['id'], file_path, file['name']))
-            else:
-                file['path'] = file_path
-                file['parent_name'] = file_path.split('/')[0] if '/' in file_path else ''
-                file['immediate_parent_name'] = file_path.split('/')[-2] if '/' in file_path else ''
-                file['modifiedTime'] = file['modifiedTime'][:-1]  # Remove 'Z' from the end
-                results.append(file)
-        page_token = response.get('nextPageToken', None)
-        if page_token is None:
-            break
+    for file_id, node in nodes.items():
+        if node['mimeType'] == FOLDER_MIME_TYPE:
+            continue
+        file = dict(node)
+        file_path = os.path.join(path, paths[file_id])
+        file['path'] = file_path
+        file['parent_name'] = file_path.split('/')[0] if '/' in file_path else ''
+        file['immediate_parent_name'] = file_path.split('/')[-2] if '/' in file_path else ''
+        file['modifiedTime'] = file['modifiedTime'][:-1]  # Remove 'Z' from the end
+        results.append(file)
     return results
 
+# Lists the files of the vault. The first sync (or a full one) walks the whole vault; afterwards only the
+# changes drive recorded since the last sync are fetched and applied to the file tree cached in the state store.
+# Returns the files, the ids of the changed files (None after a full walk) and the page token to store once
+# the changed files were processed
+def sync_vault_tree(service, service_factory, vault_id, full_sync=False):
+    store = get_state_store()
+    page_token = store.get_meta(DRIVE_PAGE_TOKEN_KEY)
+
+    if full_sync or page_token is None or store.get_meta(DRIVE_VAULT_ID_KEY) != vault_id:
+        # taken before the walk, so edits made while walking are picked up by the next sync
+        new_page_token = get_start_page_token(service)
+        nodes = walk_folder_tree(service_factory, vault_id)
+        store.replace_drive_files(nodes)
+        store.set_meta(DRIVE_VAULT_ID_KEY, vault_id)
+        return vault_files(nodes, vault_id), None, new_page_token
+
+    changes, new_page_token = list_changes(service, page_token)
+    previous_nodes = store.drive_files()
+    nodes, changed_file_ids, removed_ids = apply_changes(previous_nodes, vault_id, changes)
+    changed_nodes = {change['fileId']: nodes[change['fileId']] for change in changes if change['fileId'] in nodes}
+    # the contents of folders that came into the vault are listed, and all of their notes count as changed
+    for folder_id in entered_folders(previous_nodes, nodes):
+        listed = walk_folder_tree(service_factory, folder_id)
+        nodes.update(listed)
+        changed_nodes.update(listed)
+        changed_file_ids.update(node_id for node_id, node in listed.items() if node['mimeType'] != FOLDER_MIME_TYPE)
+    store.update_drive_files(changed_nodes, removed_ids)
+    print(f"{len(changes)} changes since the last sync: {len(changed_file_ids)} changed files, {len(removed_ids)} removed")
+    return vault_files(nodes, vault_id), changed_file_ids, new_page_token
+
 # Read file contents
 def read_file_content(service, file_id):
-    request = service.files().get_media(fileId=file_id)
-    fh = io.BytesIO()
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while done is False:
-        status, done = downloader.next_chunk()
-    return fh.getvalue().decode('utf-8')
+    return download_file(service, file_id).decode('utf-8')
 
 # Read image file and encode to base64
 def read_image_file(service, file_id):
-    request = service.files().get_media(fileId=file_id)
-    fh = io.BytesIO()
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while done is False:
-        status, done = downloader.next_chunk()
-    return base64.b64encode(fh.getvalue()).decode('utf-8')
+    return base64.b64encode(download_file(service, file_id)).decode('utf-8')
+
+# Index of the images folder (name -> id, size, md5), listed once per sync. Empty if the vault has no images folder
+def get_image_index(service, service_factory):
+    try:
+        image_folder_id = find_obsidian_vault_id(service, 'images')
+    except ValueError:
+        print("No images folder found in Google Drive.")
+        return {}
+    return build_image_index(service_factory, image_folder_id)
 
 # Find and load referenced images
-def load_referenced_images(service, content, folder_id):
-    image_pattern = r'\[\[(.*?\.(?:png|jpg|jpeg|gif))\]\]'
-    image_references = re.findall(image_pattern, content)
-    image_dict = {}
-    image_folder_id = find_obsidian_vault_id(service, 'images')
-    for image_ref in image_references:
-        image_name = os.path.basename(image_ref)
-        response = service.files().list(
-            q=f"name='{image_name}' and trashed=false and '{image_folder_id}' in parents",
-            spaces='drive',
-            fields='files(id, name)'
-        ).execute()
-        items = response.get('files', [])
-        if items:
-            image_id = items[0]['id']
-            image_content = read_image_file(service, image_id)
-            image_dict[image_name] = image_content
-        else:
-            print(f"Warning: Image not found: {image_name}")
-    
-    return image_dict
+# Images are looked up in the image index and downloaded concurrently (unless they are in the local image cache)
+def load_referenced_images(service, content, folder_id, image_index=None, service_factory=None, max_workers=DRIVE_MAX_CONCURRENCY):
+    if service_factory is None:
+        service_factory = lambda: service
+    if image_index is None:
+        image_index = get_image_index(service, service_factory)
+    return load_images(service_factory, image_index, find_image_references(content), max_workers=max_workers)
 
 # Organize Q&A pairs into sets
 def organize_qa_pairs(file_path, qa_pairs):
@@ -166,36 +205,32 @@ def organize_qa_pairs(file_path, qa_pairs):
         'qa_pairs': qa_pairs
     }
 
-# Modified Save the results function
-def save_results(results):
-    base_dir = BASE_QUESTION_SETS_DIR
-    os.makedirs(base_dir, exist_ok=True)
+# Save the QA pairs of one note into its question set of the state store
+# The new pairs are written in one transaction, under the lock of the set shared with the emailer
+def save_result(result):
+    store = get_state_store()
+    question_set = result['question_set']
+    qa_pairs = result['qa_pairs']
+
+    # Create a directory for the question set (holds its config and images)
+    set_dir = os.path.join(BASE_QUESTION_SETS_DIR, question_set)
+    os.makedirs(set_dir, exist_ok=True)
+
+    # Only the new pairs are written; existing questions of the set are kept (or updated)
+    with question_set_lock(question_set):
+        store.upsert_qa_pairs(question_set, qa_pairs)
+
+    print(f"Saved {len(qa_pairs)} Q&A pairs for {question_set} in {store.path}")
+
+    # Render the email cards of the new pairs now, so sending them is only a cache lookup
+    rendered = precompute_cards(question_set, qa_pairs)
+    print(f"{rendered} of {len(qa_pairs)} cards of {question_set} are rendered")
 
+# Save the results into the question sets of the state store, one at a time
+# (results can be any iterable, eg: a generator yielding them while they are generated)
+def save_results(results):
     for result in results:
-        question_set = result['question_set']
-        qa_pairs = result['qa_pairs']
-        
-        # Create a directory for the question set
-        set_dir = os.path.join(base_dir, question_set)
-        os.makedirs(set_dir, exist_ok=True)
-        
-        # Path for the generated_qa_pairs.json file
-        qa_file_path = os.path.join(set_dir, 'generated_qa_pairs.json')
-        
-        # Load existing Q&A pairs if the file exists
-        existing_qa_pairs = {}
-        if os.path.exists(qa_file_path):
-            with open(qa_file_path, 'r') as f:
-                existing_qa_pairs = json.load(f)
-        
-        # Update existing Q&A pairs with new ones
-        existing_qa_pairs.update(qa_pairs)
-        
-        # Save the updated Q&A pairs
-        with open(qa_file_path, 'w') as f:
-            json.dump(existing_qa_pairs, f, indent=2)
-        
-        print(f"Saved Q&A pairs for {question_set} in {qa_file_path}")
+        save_result(result)
 
     print("All results have been saved.")
 
@@ -213,31 +248,136 @@ def save_current_run_time():
         json.dump({'last_run': datetime.now().isoformat()}, f)
 
 # Modified function to check if a file should be processed
-def should_process_file(file, last_run_time):
-    modified_time = datetime.fromisoformat(file['modifiedTime'])
-    
-    if modified_time <= last_run_time:
+# After an incremental sync only the files drive reported changes for are looked at. A file whose md5 checksum
+# (or modified time) still matches its manifest entry was not edited since QA pairs were generated from it.
+# last_run_time is only passed by the first sync with the manifest (None afterwards)
+def should_process_file(file, last_run_time, changed_file_ids=None, manifest_entry=None):
+    if file['parent_name'] not in RELEVANT_FOLDERS:
         return False
+
+    # a note without a manifest entry was never processed (or failed), even if drive reports no change for it:
+    # eg: a note of a folder moved into the vault by changes an earlier, failed sync already applied
+    if manifest_entry is None:
+        if last_run_time is None:
+            return True
+        # notes from before the manifest was kept were processed by the runs up to the last one
+        modified_time = datetime.fromisoformat(file['modifiedTime'])
+        return modified_time > last_run_time
+
+    if changed_file_ids is not None and file['id'] not in changed_file_ids:
+        return False
+
+    if file.get('md5Checksum') and manifest_entry['md5_checksum']:
+        return file['md5Checksum'] != manifest_entry['md5_checksum']
+    return file['modifiedTime'] != manifest_entry['modified_time']
+
+# Hash of a note's content, ignoring line endings and trailing whitespace
+def note_content_hash(content):
+    lines = [line.rstrip() for line in content.replace('\r\n', '\n').strip().split('\n')]
+    return hashlib.sha256('\n'.join(lines).encode('utf-8')).hexdigest()
+
+# Remembers what a note looked like when it was processed (written right after its QA pairs were saved, so a partial run keeps its progress)
+def update_manifest(file, content_hash):
+    get_state_store().set_drive_manifest_entry(file['id'], file['path'], file.get('md5Checksum'), file['modifiedTime'], content_hash)
+
+# Try to find and parse the JSON part of the string GPT returned for a note
+def parse_qa_pairs(qa_pairs_str, file_path):
+    json_str = qa_pairs_str
+    start_idx = qa_pairs_str.find('{')
+    end_idx = qa_pairs_str.rfind('}')
+    if start_idx != -1 and end_idx != -1:
+        json_str = qa_pairs_str[start_idx:end_idx+1]
+
+    try:
+        return json.loads(json_str)
+    except json.JSONDecodeError as e:
+        print(f"Error decoding JSON for file: {file_path}. Error: {str(e)}")
+        print("Attempting to clean and parse the JSON string...")
+        
+        # Remove any potential leading/trailing whitespace or quotes
+        json_str = json_str.strip().strip('"').strip("'")
+        
+        # Replace any escaped quotes with regular quotes
+        json_str = json_str.replace('\\"', '"')
+        
+        # Replace single backslashes with double backslashes but leave existing double backslashes unchanged
+        # so the string can be parsed.
+        json_str = re.sub(r'(?<!\\)\\(?!\\)', r'\\\\', json_str)
+        
+        # Try parsing again
+        try:
+            return json.loads(json_str)
+        except json.JSONDecodeError:
+            print(f"Failed to parse JSON for file: {file_path}. Skipping.")
+            return {}
+
+# Download stage: reads a note and its images. Returns None if the note's text did not change since it was processed
+def download_note(service, file, manifest_entry, vault_id, image_index):
+    content = read_file_content(service, file['id'])
+    content_hash = note_content_hash(content)
+
+    # touched (or only re-saved) without changing the text
+    if manifest_entry is not None and manifest_entry['content_hash'] == content_hash:
+        print(f"Skipping file: {file['path']} as its content did not change.")
+        update_manifest(file, content_hash)
+        return None
+
+    # the notes are already downloaded DRIVE_MAX_CONCURRENCY at a time: their images are downloaded
+    # on the note's own thread and service, so the requests in flight stay within that limit
+    image_dict = load_referenced_images(service, content, vault_id, image_index, max_workers=1)
+
+    if len(image_dict.keys()) > 0:
+        print("---------<IMPORTANT>---------")
+        print("Image processing is not implemented yet!")
+        print(f"Processing file: {file['path']} without images...")
+        print("---------<\IMPORTANT>---------")
+
+    return {'file': file, 'content': content, 'content_hash': content_hash, 'images': image_dict}
+
+# GPT stage: generates and parses the QA pairs of a downloaded note
+def generate_note_qa_pairs(note):
+    file = note['file']
+
+    # Generate QA pairs with content (images are not processed for now)
+    # output that does not parse is not cached, so the next sync asks GPT again
+    qa_pairs_str = generate_qa_pairs(note['content'], file['name'], images=[], validate=lambda text: bool(parse_qa_pairs(text, file['path'])))
     
-    return file['parent_name'] in RELEVANT_FOLDERS
+    print("Raw QA pairs string:")
+    print(qa_pairs_str)
+    print("==========================")
+
+    qa_pairs = parse_qa_pairs(qa_pairs_str, file['path'])
+
+    print("Parsed QA pairs:")
+    print(json.dumps(qa_pairs, indent=2))
+    return qa_pairs
 
 # Modified main pipeline
-def main():
-    service = get_drive_service()
-    if service is None:
+# Notes go through two stages with their own thread pools: downloads (DRIVE_MAX_CONCURRENCY at a time) and GPT
+# requests (GPT_MAX_CONCURRENCY at a time). At most DRIVE_NOTES_IN_FLIGHT notes are in either stage, so downloads
+# wait for GPT instead of piling up in memory. The QA pairs of every note are saved as soon as they are generated
+def main(full_sync=False):
+    service_factory = get_drive_service_factory()
+    if service_factory is None:
         print("Failed to obtain drive service. Exiting...")
         return
+    service = service_factory()
     
     print("Trying to obtain obsidian vault id...")
     obsidian_vault_id = find_obsidian_vault_id(service)
     print("Obtained obsidian vault id...")
     print("Traversing obsidian vault...")
-    files = traverse_obsidian_vault(service, obsidian_vault_id)
+    files, changed_file_ids, new_page_token = sync_vault_tree(service, service_factory, obsidian_vault_id, full_sync)
     print("Traversed obsidian vault...")
+    image_index = get_image_index(service, service_factory)
     
-    last_run_time = load_last_run_time()
-    results = []
-    print("Generating QA pairs...")
+    store = get_state_store()
+    # the last run time only matters until the notes processed before the manifest are in it
+    migrating = store.get_meta(DRIVE_MANIFEST_MIGRATED_KEY) is None
+    last_run_time = load_last_run_time() if migrating else None
+
+    # Pick the notes to process from the listing (nothing is downloaded yet)
+    queued = deque()
     for file in files:
 
         # in this case, this file just acts as a root graph node. Skip it.
@@ -245,74 +385,82 @@ def main():
             print(f"Skipping file: {file['path']} as it acts as a root graph node.")
             continue 
 
-        if file['mimeType'] == 'text/markdown' and should_process_file(file, last_run_time):
-            content = read_file_content(service, file['id'])
-            image_dict = load_referenced_images(service, content, obsidian_vault_id)
-
-            if len(image_dict.keys()) > 0:
-                print("---------<IMPORTANT>---------")
-                print("Image processing is not implemented yet!")
-                print(f"Processing file: {file['path']} without images...")
-                print("---------<\IMPORTANT>---------")
-            
-            # Generate QA pairs with content (images are not processed for now)
-            qa_pairs_str = generate_qa_pairs(content, file['name'], images=[])
-            
-            print("Raw QA pairs string:")
-            print(qa_pairs_str)
-            print("==========================")
-
-            # Try to find and parse the JSON part of the string
-            json_str = qa_pairs_str
-            start_idx = qa_pairs_str.find('{')
-            end_idx = qa_pairs_str.rfind('}')
-            if start_idx != -1 and end_idx != -1:
-                json_str = qa_pairs_str[start_idx:end_idx+1]
+        if file['mimeType'] != 'text/markdown':
+            print(f"Skipping file: {file['path']}")
+            continue
 
-            try:
-                qa_pairs = json.loads(json_str)
-            except json.JSONDecodeError as e:
-                print(f"Error decoding JSON for file: {file['path']}. Error: {str(e)}")
-                print("Attempting to clean and parse the JSON string...")
-                
-                # Remove any potential leading/trailing whitespace or quotes
-                json_str = json_str.strip().strip('"').strip("'")
-                
-                # Replace any escaped quotes with regular quotes
-                json_str = json_str.replace('\\"', '"')
-                
-                # Replace single backslashes with double backslashes but leave existing double backslashes unchanged
-                # so the string can be parsed.
-                json_str = re.sub(r'(?<!\\)\\(?!\\)', r'\\\\', json_str)
-                
-                # Try parsing again
+        manifest_entry = store.drive_manifest_entry(file['id'])
+        if should_process_file(file, last_run_time, changed_file_ids, manifest_entry):
+            queued.append((file, manifest_entry))
+        else:
+            if migrating and manifest_entry is None and file['parent_name'] in RELEVANT_FOLDERS:
+                # processed before the manifest was kept
+                update_manifest(file, None)
+            print(f"Skipping file: {file['path']}")
+
+    print(f"Generating QA pairs for {len(queued)} notes...")
+    services = DriveServicePool(service_factory)
+    downloads = {}
+    generations = {}
+    failed = 0
+    with ThreadPoolExecutor(max_workers=DRIVE_MAX_CONCURRENCY, thread_name_prefix="drive-notes") as download_pool, GPTWorkerPool() as gpt_pool:
+        while queued or downloads or generations:
+            while queued and len(downloads) + len(generations) < DRIVE_NOTES_IN_FLIGHT:
+                file, manifest_entry = queued.popleft()
+                future = download_pool.submit(lambda file=file, manifest_entry=manifest_entry: download_note(
+                    services.get(), file, manifest_entry, obsidian_vault_id, image_index
+                ))
+                downloads[future] = file
+
+            done, _ = wait(list(downloads) + list(generations), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in downloads:
+                    file = downloads.pop(future)
+                    try:
+                        note = future.result()
+                    except Exception as e:
+                        print(f"Failed to download file: {file['path']}. Error: {str(e)}")
+                        failed += 1
+                        continue
+                    if note is not None:
+                        generations[gpt_pool.submit(generate_note_qa_pairs, note)] = note
+                    continue
+
+                note = generations.pop(future)
+                file = note['file']
                 try:
-                    qa_pairs = json.loads(json_str)
-                except json.JSONDecodeError:
-                    print(f"Failed to parse JSON for file: {file['path']}. Skipping.")
-                    qa_pairs = {}
-
-            print("Parsed QA pairs:")
-            print(json.dumps(qa_pairs, indent=2))
-            
-            if qa_pairs:
+                    qa_pairs = future.result()
+                except Exception as e:
+                    print(f"Failed to generate QA pairs for file: {file['path']}. Error: {str(e)}")
+                    failed += 1
+                    continue
+
+                if not qa_pairs:
+                    # empty or unparseable output: the manifest is not updated, so the next sync tries again
+                    print(f"No valid QA pairs generated for file: {file['path']}.")
+                    failed += 1
+                    continue
+
                 print(f"Generated QA pairs for file: {file['path']}")
                 organized_qa = organize_qa_pairs(file['path'], qa_pairs)
-                results.append(organized_qa)
-
-            else:
-                print(f"No valid QA pairs generated for file: {file['path']}. Skipping.")
-        else:
-            print(f"Skipping file: {file['path']}")
-        
+                save_result(organized_qa)
+                update_manifest(file, note['content_hash'])
 
-    
     print("Generated QA pairs...")
-    save_results(results)
+    if failed:
+        # the changes are fetched again by the next sync; the notes that were processed are skipped by the manifest
+        print(f"{failed} notes failed. They are retried by the next sync.")
+        return
+    # only now the changes up to here count as processed
     save_current_run_time()
+    store.set_meta(DRIVE_PAGE_TOKEN_KEY, new_page_token)
+    store.set_meta(DRIVE_MANIFEST_MIGRATED_KEY, '1')
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate question-answer pairs from the notes of the obsidian vault on google drive.")
+    parser.add_argument('--full-sync', action='store_true', help="walk the whole vault instead of only fetching the changes since the last sync")
+    args = parser.parse_args()
     try:
-        main()
+        main(full_sync=args.full_sync)
     except Exception as e:
         email_unknown_error(str(e))
\ No newline at end of file
@@ -0,0 +1,89 @@
+import os
+import re
+import base64
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from json_store import atomic_write_bytes
+from google_drive_sync.drive_traversal import FOLDER_MIME_TYPE, DriveServicePool, walk_folder_tree, download_file
+from config import DRIVE_MAX_CONCURRENCY, IMAGE_CACHE_DIRECTORY
+
+# obsidian embeds images as [[name.png]] (or [[folder/name.png]])
+IMAGE_REFERENCE_PATTERN = r'\[\[(.*?\.(?:png|jpg|jpeg|gif))\]\]'
+
+
+def find_image_references(content):
+    """Returns the file names of the images a note embeds, without duplicates, in order."""
+    names = []
+    for image_ref in re.findall(IMAGE_REFERENCE_PATTERN, content):
+        image_name = os.path.basename(image_ref)
+        if image_name not in names:
+            names.append(image_name)
+    return names
+
+
+def build_image_index(service_factory, images_folder_id):
+    """
+    Lists the images folder (and its subfolders) once.
+
+    Returns:
+        dict: {image name: {"id", "size", "md5Checksum"}}; for names used more than once, the first image listed
+    """
+    index = {}
+    for file in walk_folder_tree(service_factory, images_folder_id).values():
+        if file['mimeType'] != FOLDER_MIME_TYPE and file['name'] not in index:
+            index[file['name']] = {'id': file['id'], 'size': file.get('size'), 'md5Checksum': file.get('md5Checksum')}
+    return index
+
+
+class ImageCache:
+    """
+    Local copies of drive images, stored under their md5 checksum: an image is only downloaded again
+    when its content changed, and images with the same content are stored once.
+    """
+
+    def __init__(self, directory=IMAGE_CACHE_DIRECTORY):
+        self.directory = directory
+
+    def _path(self, md5_checksum, name):
+        return os.path.join(self.directory, md5_checksum + os.path.splitext(name)[1].lower())
+
+    def load(self, service, name, image):
+        """Returns the content of an image of the image index, downloading it only if it is not cached."""
+        md5_checksum = image.get('md5Checksum')
+        if md5_checksum:
+            path = self._path(md5_checksum, name)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    return f.read()
+
+        data = download_file(service, image['id'])
+        # only content that arrived intact is cached
+        if md5_checksum and hashlib.md5(data).hexdigest() == md5_checksum:
+            atomic_write_bytes(path, data)
+        return data
+
+
+def load_images(service_factory, image_index, names, image_cache=None, max_workers=DRIVE_MAX_CONCURRENCY):
+    """
+    Loads images of the image index by name, downloading the ones that are not cached concurrently
+    (one after another on the calling thread when max_workers is 1).
+
+    Returns:
+        dict: {image name: base64 encoded content} of every image that was found
+    """
+    image_cache = image_cache or ImageCache()
+    found = [name for name in names if name in image_index]
+    for name in names:
+        if name not in image_index:
+            print(f"Warning: Image not found: {name}")
+    if not found:
+        return {}
+
+    if max_workers <= 1:
+        service = service_factory()
+        return {name: base64.b64encode(image_cache.load(service, name, image_index[name])).decode('utf-8') for name in found}
+
+    services = DriveServicePool(service_factory)
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(found)), thread_name_prefix="drive-images") as pool:
+        contents = pool.map(lambda name: image_cache.load(services.get(), name, image_index[name]), found)
+        return {name: base64.b64encode(data).decode('utf-8') for name, data in zip(found, contents)}
@@ -0,0 +1,182 @@
+import os
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import openai
+from openai import OpenAI
+from llm_cache import get_llm_cache, request_key
+from config import OPENAI_BASE_URL, GPT_MAX_CONCURRENCY, GPT_REQUESTS_PER_MINUTE, GPT_TOKENS_PER_MINUTE, GPT_MAX_RETRIES
+
+# delay before the first retry; doubles with every further retry
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+
+
+class RateLimiter:
+    """
+    Token buckets for requests per minute and tokens per minute, shared by all threads.
+    acquire() blocks until a request of the given size fits into both budgets.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._available_requests = float(requests_per_minute)
+        self._available_tokens = float(tokens_per_minute)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._available_requests = min(self.requests_per_minute, self._available_requests + elapsed * self.requests_per_minute / 60)
+        self._available_tokens = min(self.tokens_per_minute, self._available_tokens + elapsed * self.tokens_per_minute / 60)
+
+    def acquire(self, tokens):
+        # a single request larger than the whole budget only has to wait for a full bucket
+        tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self._lock:
+                self._refill()
+                if self._available_requests >= 1 and self._available_tokens >= tokens:
+                    self._available_requests -= 1
+                    self._available_tokens -= tokens
+                    return
+                missing_requests = max(0.0, 1 - self._available_requests)
+                missing_tokens = max(0.0, tokens - self._available_tokens)
+                wait = max(missing_requests * 60 / self.requests_per_minute, missing_tokens * 60 / self.tokens_per_minute)
+            time.sleep(wait)
+
+
+_client = None
+_rate_limiter = RateLimiter(GPT_REQUESTS_PER_MINUTE, GPT_TOKENS_PER_MINUTE)
+_client_lock = threading.Lock()
+
+
+def get_openai_client():
+    """
+    Returns the OpenAI client shared by the pipelines. OPENAI_BASE_URL can point it at any
+    OpenAI compatible server (eg: a local fake one for testing).
+    Retries are done by call_with_retry, so the client itself does not retry.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), base_url=OPENAI_BASE_URL, max_retries=0)
+        return _client
+
+
+def estimate_tokens(messages, max_tokens=None):
+    """Rough number of tokens a request uses (about 4 characters per token, plus the completion)."""
+    characters = 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            characters += len(content)
+        else:
+            characters += sum(len(part.get("text", "")) for part in content)
+    return characters // 4 + (max_tokens or 1000)
+
+
+def _is_retryable(error):
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+def _retry_delay(error, attempt):
+    """Exponential backoff with full jitter; a Retry-After header sent by the server wins."""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def call_with_retry(fn, *args, max_retries=GPT_MAX_RETRIES, before_attempt=None, **kwargs):
+    """
+    Calls fn, retrying rate limit (429), server (5xx) and connection errors with jittered
+    exponential backoff. before_attempt is called before every attempt (eg: to wait for a rate limit).
+    """
+    for attempt in range(max_retries + 1):
+        if before_attempt is not None:
+            before_attempt()
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt == max_retries or not _is_retryable(e):
+                raise
+            delay = _retry_delay(e, attempt)
+            print(f"OpenAI request failed ({e.__class__.__name__}), retrying in {delay:.1f}s...")
+            time.sleep(delay)
+
+
+def chat_completion(messages, model, max_retries=GPT_MAX_RETRIES, **params):
+    """
+    Sends a chat completion request, waiting for the rate limits first and retrying rate limit
+    (429) and server (5xx) errors with jittered exponential backoff.
+
+    Returns:
+        ChatCompletion: The response of the API.
+    """
+    client = get_openai_client()
+    tokens = estimate_tokens(messages, params.get("max_tokens"))
+    return call_with_retry(
+        client.chat.completions.create, model=model, messages=messages, max_retries=max_retries,
+        before_attempt=lambda: _rate_limiter.acquire(tokens), **params
+    )
+
+
+def chat_completion_text(messages, model, validate=None, **params):
+    """
+    Returns the text of the response to a chat completion request. Identical requests (same model,
+    messages and parameters) are answered from the LLM response cache instead of the API.
+
+    Only responses that are complete (not cut off by max_tokens) and pass validate (a callable taking
+    the text, eg: checking it parses) are cached, so a bad response is not replayed by the next try.
+    A cached response that does not pass validate is requested again. A response without any text
+    (eg: a refusal) raises an exception.
+    """
+    cache = get_llm_cache()
+    key = request_key(model, messages, **params)
+    cached_response = cache.get(key)
+    if cached_response is not None and (validate is None or validate(cached_response)):
+        return cached_response
+
+    response = chat_completion(messages, model, **params)
+    if not response.choices:
+        raise Exception("Unexpected response format from OpenAI API")
+    text = response.choices[0].message.content
+    # refusals and filtered responses come without any content
+    if not text or not text.strip():
+        raise Exception(f"Empty response from OpenAI API (finish reason: {response.choices[0].finish_reason})")
+    if response.choices[0].finish_reason != "length" and (validate is None or validate(text)):
+        cache.put(key, text)
+    return text
+
+
+class GPTWorkerPool:
+    """
+    Bounded pool of threads for GPT requests. Jobs are submitted as soon as their input is ready,
+    so the caller can keep preparing the next inputs while earlier requests are in flight.
+    """
+
+    def __init__(self, max_workers=GPT_MAX_CONCURRENCY):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gpt")
+
+    def submit(self, fn, *args, **kwargs):
+        return self._executor.submit(fn, *args, **kwargs)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
@@ -1,7 +1,7 @@
 import os
 import base64
 import requests
-from openai import OpenAI
+from gpt_client import chat_completion_text
 from PIL import Image
 import io
 import imghdr
@@ -20,10 +20,7 @@ def encode_image(image_path):
         print(f"Error processing image {image_path}: {str(e)}. Skipping.")
         return None
 
-def generate_qa_pairs(content, file_name, images=None, model="gpt-4o", num_pairs="3-5"):
-    api_key = os.getenv("OPENAI_API_KEY")
-    client = OpenAI(api_key=api_key)
-
+def generate_qa_pairs(content, file_name, images=None, model="gpt-4o", num_pairs="3-5", validate=None):
     SYSTEM_PROMPT = """
     You will be given a markdown file written in Obsidian (possibly with LaTeX and images). It will contain the topic of the notes in the last line. Based on this topic, generate a question-answer pair in the form of a JSON object with the following schema:
     {
@@ -92,18 +89,16 @@ def generate_qa_pairs(content, file_name, images=None, model="gpt-4o", num_pairs
 
 
     try:
-        response = client.chat.completions.create(
+        # unchanged notes (same content, images and prompt) are answered from the LLM response cache
+        # (only if the response passed validate the first time)
+        qa_pairs = chat_completion_text(
             model=model,
             messages=messages,
+            validate=validate,
             max_tokens=8000
         )
-        
-        if hasattr(response, 'choices') and len(response.choices) > 0:
-            qa_pairs = response.choices[0].message.content
-            # print(qa_pairs)
-            return qa_pairs
-        else:
-            raise Exception("Unexpected response format from OpenAI API")
+        # print(qa_pairs)
+        return qa_pairs
     except Exception as e:
         print(f"Error calling OpenAI API: {str(e)}")
         raise Exception(f"Error calling OpenAI API: {str(e)}")
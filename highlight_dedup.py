@@ -0,0 +1,97 @@
+from pdf_page_index import normalize_page_text
+
+# highlights on the same page sharing at least this many (normalized) characters, where one ends with
+# the start of the other or contains the other, are one highlight that was extended or re-highlighted
+MIN_OVERLAP_CHARACTERS = 20
+
+
+def highlights_overlap(first, second):
+    """
+    Whether two normalized highlights are the same passage: equal, one containing the other, or the
+    end of one being the start of the other (by at least MIN_OVERLAP_CHARACTERS characters).
+    """
+    if first == second:
+        return True
+    shorter, longer = sorted((first, second), key=len)
+    if len(shorter) < MIN_OVERLAP_CHARACTERS:
+        return False
+    if shorter in longer:
+        return True
+    return _ends_with_start_of(first, second) or _ends_with_start_of(second, first)
+
+
+def _ends_with_start_of(text, other):
+    """Whether text ends with at least MIN_OVERLAP_CHARACTERS characters other starts with."""
+    prefix = other[:MIN_OVERLAP_CHARACTERS]
+    position = text.find(prefix)
+    while position != -1:
+        if other.startswith(text[position:]):
+            return True
+        position = text.find(prefix, position + 1)
+    return False
+
+
+def deduplicate_highlights(book_highlights, processed_highlights=()):
+    """
+    Collapses the highlights of a book that are the same passage (see highlights_overlap) on the same
+    page into one canonical entry: the longest of them, so its context covers all the others.
+
+    Kindle appends an extended highlight as a new entry, often after the original was processed by
+    an earlier run. A new highlight that is the same passage as a processed one is merged into the
+    processed one, which stays canonical as it already has a context and QA pairs, unless the new
+    highlight is longer: then it becomes canonical (and needs a context) and the processed highlights
+    of the passage become its duplicates.
+
+    Args:
+        book_highlights (list): The new {"highlight", "page_number"} entries of one book, in clippings order
+        processed_highlights (list): The {"highlight", "page_number"} entries of the book processed by earlier runs
+
+    Returns:
+        list: The canonical entries in the order their passages were first highlighted (among the new entries),
+        each with the texts of the highlights it stands for in "duplicates", and "processed" set when the
+        canonical entry is a processed highlight.
+    """
+    groups = []
+    groups_by_page = {}
+
+    def group_of(entry):
+        normalized = normalize_page_text(entry["highlight"])
+        page_groups = groups_by_page.setdefault(entry["page_number"], [])
+        group = next((group for group in page_groups if any(highlights_overlap(normalized, member) for member, _, _ in group)), None)
+        if group is None:
+            group = []
+            page_groups.append(group)
+        return normalized, group
+
+    for entry in processed_highlights:
+        normalized, group = group_of(entry)
+        group.append((normalized, entry, True))
+
+    grouped = set()
+    for entry in book_highlights:
+        normalized, group = group_of(entry)
+        if id(group) not in grouped:
+            grouped.add(id(group))
+            groups.append(group)
+        group.append((normalized, entry, False))
+
+    canonical_entries = []
+    for group in groups:
+        processed = [entry for _, entry, is_processed in group if is_processed]
+        # the longest highlight wins; on ties the latest one (kindle appends extended highlights)
+        canonical = max(reversed([entry for _, entry, is_processed in group if not is_processed]), key=lambda entry: len(entry["highlight"]))
+        canonical_is_processed = False
+        if processed:
+            longest_processed = max(processed, key=lambda entry: len(entry["highlight"]))
+            # a processed highlight only gives way to a new one that covers more of the passage
+            if len(longest_processed["highlight"]) >= len(canonical["highlight"]):
+                canonical, canonical_is_processed = longest_processed, True
+        duplicates = []
+        for _, entry, is_processed in group:
+            # processed highlights keep their own context, unless a new highlight replaces them as canonical
+            if is_processed and canonical_is_processed:
+                continue
+            if entry["highlight"] != canonical["highlight"] and entry["highlight"] not in duplicates:
+                duplicates.append(entry["highlight"])
+        canonical_entries.append(dict(canonical, duplicates=duplicates, processed=canonical_is_processed))
+    return canonical_entries
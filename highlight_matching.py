@@ -0,0 +1,273 @@
+from bisect import bisect_right
+from collections import Counter, namedtuple
+import numpy as np
+from rapidfuzz import fuzz
+from pdf_page_index import normalize_page_text
+
+# minimum partial ratio for a highlight to count as found
+# sometimes the strings in highlights are different than the pdf (eg: "field" in pdf -> "feld" in highlight)
+MATCH_SCORE_THRESHOLD = 80
+
+# pages (starting at the one kindle reported) that are aligned directly before the n-gram index is used
+GUIDED_PAGES = 3
+
+# byte n-grams of the normalized book text, indexed every NGRAM_STRIDE bytes (8 bytes: one uint64 per n-gram)
+NGRAM_SIZE = 8
+NGRAM_STRIDE = 4
+# n-grams occurring more often than this carry no information about where a highlight is
+MAX_NGRAM_POSTINGS = 200
+
+# candidate match positions are voted for in buckets of this many characters
+CANDIDATE_BUCKET_SIZE = 16
+MAX_CANDIDATES = 5
+
+# page_index: page of the pdf the match starts on
+# start / end: character offsets of the match in the raw text of that page (end can run into the next pages)
+# score: partial ratio between the highlight and the matched text
+HighlightMatch = namedtuple("HighlightMatch", ["page_index", "start", "end", "score"])
+
+# the n-gram index of the book being searched, with the page index it was built from. Only one is kept:
+# an index takes several times the size of its book's text, and the books are searched one after the other
+_ngram_index = None
+
+
+def candidate_page_order(num_pages, page_number, offset):
+    """
+    Yields the page indices of a PDF in the order they should be searched for a highlight:
+    the page kindle reported first, then widening outwards (+1, -1, +2, -2, ...)
+    until every page was covered.
+
+    Args:
+        num_pages (int): The number of pages in the PDF
+        page_number (int): The page number kindle reported for the highlight (may be None)
+        offset (int): The offset between reported page numbers and page indices of the book
+
+    Returns:
+        generator: The page indices to search, in order.
+    """
+    if page_number is None:
+        yield from range(num_pages)
+        return
+
+    expected_index = min(max(page_number + offset, 0), num_pages - 1)
+    yield expected_index
+    for distance in range(1, num_pages):
+        below, above = expected_index - distance, expected_index + distance
+        if above >= num_pages and below < 0:
+            break
+        if above < num_pages:
+            yield above
+        if below >= 0:
+            yield below
+
+
+def _ngrams(data, stride):
+    """Returns the NGRAM_SIZE byte n-grams of a uint8 array starting every stride bytes, each packed into a uint64."""
+    if len(data) < NGRAM_SIZE:
+        return np.empty(0, dtype=np.uint64)
+    windows = np.lib.stride_tricks.sliding_window_view(data, NGRAM_SIZE)[::stride]
+    return np.ascontiguousarray(windows).view(np.uint64).ravel()
+
+
+class NGramIndex:
+    """
+    Inverted index from byte n-grams to their offsets in the normalized (UTF-8) text of a whole book.
+    Used to shortlist the few places in a book where a highlight can be, so that only those
+    places have to be aligned against the highlight.
+
+    The n-grams are read from the memory map of the book's page index, and kept as two arrays sorted
+    by n-gram (n-grams, offsets), about 3 bytes per byte of text. Offsets are bytes into the text.
+    """
+
+    def __init__(self, page_index):
+        self.page_index = page_index
+        self.text = page_index.normalized_text()
+        self.page_starts = [offset - page_index.normalized_offsets[0] for offset in page_index.normalized_offsets[:-1]]
+
+        ngrams = _ngrams(np.frombuffer(self.text, dtype=np.uint8), NGRAM_STRIDE)
+        offsets = np.arange(len(ngrams), dtype=np.uint32) * NGRAM_STRIDE
+        order = np.argsort(ngrams, kind='stable')
+        ngrams, offsets = ngrams[order], offsets[order]
+        _, counts = np.unique(ngrams, return_counts=True)
+        frequent = np.repeat(counts > MAX_NGRAM_POSTINGS, counts)
+        self.ngrams = ngrams[~frequent]
+        self.offsets = offsets[~frequent]
+
+    def page_of(self, offset):
+        """Returns the page index the given offset of the normalized book text is on."""
+        return bisect_right(self.page_starts, offset) - 1
+
+    def candidate_offsets(self, query):
+        """
+        Returns the offsets in the normalized book text where the query most likely starts,
+        best candidates first.
+        """
+        query_ngrams = _ngrams(np.frombuffer(query.encode('utf-8'), dtype=np.uint8), 1)
+        firsts = np.searchsorted(self.ngrams, query_ngrams, side='left')
+        lasts = np.searchsorted(self.ngrams, query_ngrams, side='right')
+        votes = Counter()
+        for query_position, (first, last) in enumerate(zip(firsts.tolist(), lasts.tolist())):
+            if first < last:
+                votes.update(((self.offsets[first:last].astype(np.int64) - query_position) // CANDIDATE_BUCKET_SIZE).tolist())
+        return [max(0, bucket * CANDIDATE_BUCKET_SIZE) for bucket, _ in votes.most_common(MAX_CANDIDATES)]
+
+    def _character_start(self, offset):
+        """Moves an offset forward to the start of the UTF-8 character it is in."""
+        while offset < len(self.text) and self.text[offset] & 0xC0 == 0x80:
+            offset += 1
+        return offset
+
+    def align_near(self, query, offset, slack):
+        """
+        Aligns the query against the text around an offset, decoding only that part of the book.
+
+        Returns:
+            tuple: (score, start, end) of the best alignment, as offsets into the normalized book text.
+        """
+        window_start = self._character_start(max(0, offset - slack))
+        window_end = self._character_start(min(len(self.text), offset + len(query.encode('utf-8')) + slack))
+        window = bytes(self.text[window_start:window_end]).decode('utf-8')
+        score, start, end = align(query, window)
+        return score, window_start + len(window[:start].encode('utf-8')), window_start + len(window[:end].encode('utf-8'))
+
+    def characters_between(self, start, end):
+        """The number of characters between two offsets of the normalized book text."""
+        return len(bytes(self.text[start:end]).decode('utf-8'))
+
+
+def get_ngram_index(page_index):
+    """Returns the n-gram index of a book, building it (and dropping the previous book's) when it is first needed."""
+    global _ngram_index
+    if _ngram_index is None or _ngram_index[0] is not page_index:
+        _ngram_index = None  # freed before the next one is built
+        _ngram_index = (page_index, NGramIndex(page_index))
+    return _ngram_index[1]
+
+
+def release_ngram_index():
+    """Frees the n-gram index kept for the last book searched."""
+    global _ngram_index
+    _ngram_index = None
+
+
+def align(query, text, approximate_start=0, slack=None):
+    """
+    Aligns the query against the part of the text around approximate_start.
+
+    Returns:
+        tuple: (score, start, end) of the best alignment, as offsets into text.
+    """
+    if slack is None:
+        window_start, window_end = 0, len(text)
+    else:
+        window_start = max(0, approximate_start - slack)
+        window_end = min(len(text), approximate_start + len(query) + slack)
+    alignment = fuzz.partial_ratio_alignment(query, text[window_start:window_end])
+    return alignment.score, window_start + alignment.dest_start, window_start + alignment.dest_end
+
+
+def normalized_to_raw_offset(raw_text, normalized_offset):
+    """Maps an offset in the normalized text of a page back to the raw text of the page."""
+    count = 0
+    for raw_offset, character in enumerate(raw_text):
+        if character in " \n":
+            continue
+        if count >= normalized_offset:
+            return raw_offset
+        count += len(character.lower())
+    return len(raw_text)
+
+
+def _to_raw_match(page_index, page_idx, normalized_start, normalized_end, score):
+    """Converts a match in normalized page text (end may run over into the next pages) to raw offsets."""
+    raw_start = normalized_to_raw_offset(page_index.raw_page(page_idx), normalized_start)
+    raw_end_base = 0
+    end_page_idx = page_idx
+    while normalized_end > len(page_index.normalized_page(end_page_idx)) and end_page_idx + 1 < len(page_index):
+        normalized_end -= len(page_index.normalized_page(end_page_idx))
+        raw_end_base += len(page_index.raw_page(end_page_idx))
+        end_page_idx += 1
+    raw_end = raw_end_base + normalized_to_raw_offset(page_index.raw_page(end_page_idx), normalized_end)
+    return HighlightMatch(page_idx, raw_start, raw_end, score)
+
+
+def find_highlight(page_index, highlight_text, page_number=None, offset=0):
+    """
+    Finds a highlight in a book.
+
+    The pages around the page kindle reported are aligned directly first. If the highlight is not
+    found there, an n-gram index of the whole book shortlists candidate offsets and the highlight
+    is only aligned near those.
+
+    Args:
+        page_index (PageTextIndex): The page texts of the book
+        highlight_text (str): The highlight text to search for
+        page_number (int): The page number kindle reported for the highlight (may be None)
+        offset (int): The offset between reported page numbers and page indices of the book
+
+    Returns:
+        HighlightMatch: Where the highlight is in the book, or None if it was not found.
+    """
+    query = normalize_page_text(highlight_text)
+    if not query or len(page_index) == 0:
+        return None
+
+    page_order = candidate_page_order(len(page_index), page_number, offset)
+
+    # most highlights are on the reported page (or right next to it)
+    if page_number is not None:
+        for _ in range(min(GUIDED_PAGES, len(page_index))):
+            page_idx = next(page_order)
+            score, start, end = align(query, page_index.normalized_page(page_idx))
+            if score > MATCH_SCORE_THRESHOLD:
+                return _to_raw_match(page_index, page_idx, start, end, score)
+
+    ngram_index = get_ngram_index(page_index)
+    candidates = ngram_index.candidate_offsets(query)
+    best = None
+    for candidate in candidates:
+        score, start, end = ngram_index.align_near(query, candidate, slack=len(query.encode('utf-8')) // 2 + CANDIDATE_BUCKET_SIZE)
+        if score > MATCH_SCORE_THRESHOLD and (best is None or score > best[0]):
+            best = (score, start, end)
+    if best is not None:
+        score, start, end = best
+        page_idx = ngram_index.page_of(start)
+        page_start = ngram_index.page_starts[page_idx]
+        # byte offsets into the book back to character offsets into the page
+        return _to_raw_match(
+            page_index, page_idx, ngram_index.characters_between(page_start, start), ngram_index.characters_between(page_start, end), score
+        )
+
+    # highlights too short (or too garbled) to share any n-gram with the book are searched page by page
+    if not candidates:
+        for page_idx in page_order:
+            score, start, end = align(query, page_index.normalized_page(page_idx))
+            if score > MATCH_SCORE_THRESHOLD:
+                return _to_raw_match(page_index, page_idx, start, end, score)
+
+    return None
+
+
+def context_around(page_index, match, window):
+    """
+    Returns the raw text around a match, window characters to either side.
+    The window may reach into the previous and next pages.
+    """
+    page_idx = match.page_index
+    text = page_index.raw_page(page_idx)
+    start, end = match.start, match.end
+
+    previous_idx = page_idx
+    while start - window < 0 and previous_idx > 0:
+        previous_idx -= 1
+        previous_text = page_index.raw_page(previous_idx)
+        text = previous_text + text
+        start += len(previous_text)
+        end += len(previous_text)
+
+    next_idx = page_idx
+    while end + window > len(text) and next_idx + 1 < len(page_index):
+        next_idx += 1
+        text += page_index.raw_page(next_idx)
+
+    return text[max(0, start - window):min(len(text), end + window)]
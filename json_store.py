@@ -0,0 +1,115 @@
+import os
+import json
+import time
+import atexit
+import tempfile
+import threading
+
+
+def atomic_write_json(path, data, indent=None):
+    """
+    Writes data as json to path by writing a temporary file next to it and renaming it over the
+    old file, so a crash never leaves a truncated or half written file behind.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=indent)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def atomic_write_bytes(path, data):
+    """Writes bytes to path the same way atomic_write_json writes json."""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class BatchedJsonFile:
+    """
+    A json file holding a dict that is loaded once and kept in memory.
+
+    Writes only change the in-memory dict; the file is rewritten (atomically) once flush_every
+    writes were collected or flush_seconds passed since the last flush, and when the process exits.
+    Changes to nested values have to be reported with mark_dirty().
+    """
+
+    def __init__(self, path, flush_every=20, flush_seconds=30, indent=None):
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+        self.indent = indent
+        self._lock = threading.RLock()
+        self._pending_writes = 0
+        self._last_flush = time.monotonic()
+        self.data = self._load()
+        atexit.register(self.flush)
+
+    def _load(self):
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        return {}
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self.data[key] = value
+            self.mark_dirty()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def setdefault(self, key, default=None):
+        with self._lock:
+            if key not in self.data:
+                self[key] = default
+            return self.data[key]
+
+    def items(self):
+        return self.data.items()
+
+    def keys(self):
+        return self.data.keys()
+
+    def mark_dirty(self):
+        """Records a write and flushes if enough writes or time piled up since the last flush."""
+        with self._lock:
+            self._pending_writes += 1
+            if self._pending_writes >= self.flush_every or time.monotonic() - self._last_flush >= self.flush_seconds:
+                self.flush()
+
+    def flush(self):
+        """Writes the dict to the file if anything changed since the last flush."""
+        with self._lock:
+            if self._pending_writes == 0:
+                return
+            atomic_write_json(self.path, self.data, indent=self.indent)
+            self._pending_writes = 0
+            self._last_flush = time.monotonic()
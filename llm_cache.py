@@ -0,0 +1,132 @@
+import os
+import json
+import time
+import atexit
+import sqlite3
+import hashlib
+import threading
+from config import LLM_CACHE_FILE, LLM_CACHE_MAX_BYTES
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    response TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+CREATE TABLE IF NOT EXISTS stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+def request_key(model, messages, **params):
+    """
+    Content address of a request: a hash of the model, the messages (system prompt and user content)
+    and every other parameter. Identical requests get the same key no matter where they come from.
+    """
+    request = {"model": model, "messages": messages, "params": params}
+    return hashlib.sha256(json.dumps(request, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class LLMResponseCache:
+    """
+    On-disk cache of LLM responses keyed by request_key, evicting the least recently used
+    responses once they take more than max_bytes. Counts hits and misses (this run and overall).
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+
+    def get(self, key):
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                self._count("misses")
+                return None
+            self.hits += 1
+            self._count("hits")
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key, response):
+        size = len(response.encode('utf-8'))
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO responses (key, response, size, last_used) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET response = excluded.response, size = excluded.size, last_used = excluded.last_used",
+                (key, response, size, time.time())
+            )
+            self._evict()
+
+    def _count(self, name):
+        self._conn.execute(
+            "INSERT INTO stats (name, value) VALUES (?, 1) ON CONFLICT (name) DO UPDATE SET value = value + 1", (name,)
+        )
+
+    def _evict(self):
+        """Deletes the least recently used responses until the cache fits into max_bytes."""
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = 0
+        for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY last_used").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            evicted += 1
+        self._conn.execute(
+            "INSERT INTO stats (name, value) VALUES ('evictions', ?) ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+            (evicted,)
+        )
+
+    def stats(self):
+        """Returns the hits and misses of this run and the totals since the cache was created."""
+        with self._lock:
+            totals = dict(self._conn.execute("SELECT name, value FROM stats").fetchall())
+            entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "total_hits": totals.get("hits", 0),
+            "total_misses": totals.get("misses", 0),
+            "evictions": totals.get("evictions", 0),
+            "entries": entries,
+            "bytes": size,
+        }
+
+    def print_stats(self):
+        if self.hits or self.misses:
+            stats = self.stats()
+            print(
+                f"LLM response cache: {stats['hits']} hits, {stats['misses']} misses this run "
+                f"({stats['total_hits']} hits, {stats['total_misses']} misses overall; "
+                f"{stats['entries']} responses, {stats['bytes'] / 1e6:.1f} MB)"
+            )
+
+
+_llm_cache = None
+_llm_cache_lock = threading.Lock()
+
+
+def get_llm_cache():
+    """Returns the response cache shared by every LLM call site of this process."""
+    global _llm_cache
+    with _llm_cache_lock:
+        if _llm_cache is None:
+            _llm_cache = LLMResponseCache(LLM_CACHE_FILE, LLM_CACHE_MAX_BYTES)
+            atexit.register(_llm_cache.print_stats)
+        return _llm_cache
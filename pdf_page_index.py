@@ -0,0 +1,171 @@
+import os
+import json
+import mmap
+import hashlib
+import tempfile
+import ebooklib
+from ebooklib import epub
+from bs4 import BeautifulSoup
+from PyPDF2 import PdfReader
+from json_store import atomic_write_json
+from config import PAGE_INDEX_DIRECTORY
+
+# bump this whenever the layout of the stored index changes so old indexes get rebuilt
+PAGE_INDEX_VERSION = 2
+
+# indexes that were already loaded during this run, keyed by the book's index key
+_loaded_indexes = {}
+
+
+def normalize_page_text(page_text):
+    """
+    Normalize the text of a page the same way highlights are compared against it:
+    newlines and spaces removed, lowercased.
+    """
+    return page_text.replace("\n", "").replace(" ", "").lower()
+
+
+def book_index_key(file_path):
+    """
+    Builds the key of a book's page index from the file's path, size and mtime,
+    so that an index is rebuilt whenever the file is replaced or modified.
+    """
+    stat = os.stat(file_path)
+    identity = f"{os.path.abspath(file_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+    return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+
+class PageTextIndex:
+    """
+    The extracted text of every page of a book, in both raw and normalized form.
+    The pages of an EPUB are the documents of its spine (usually one per chapter), in reading order.
+
+    The text is not held in memory: it is read through a memory map of the book's text file, where
+    all raw pages and then all normalized pages are stored back to back as UTF-8, and only the pages
+    that are asked for are decoded. Processes working on the same book share its pages through the
+    OS page cache.
+    """
+
+    def __init__(self, file_path, text_path, raw_offsets, normalized_offsets):
+        self.file_path = file_path
+        self.text_path = text_path
+        # byte offsets of the start of every page in the text file, plus the end of the last page
+        self.raw_offsets = raw_offsets
+        self.normalized_offsets = normalized_offsets
+        with open(text_path, 'rb') as f:
+            # an empty file (a book without any text) cannot be mapped
+            self._text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+
+    def __len__(self):
+        return len(self.raw_offsets) - 1
+
+    def raw_page(self, page_index):
+        return self._text[self.raw_offsets[page_index]:self.raw_offsets[page_index + 1]].decode('utf-8')
+
+    def normalized_page(self, page_index):
+        return self._text[self.normalized_offsets[page_index]:self.normalized_offsets[page_index + 1]].decode('utf-8')
+
+    def normalized_text(self):
+        """The UTF-8 normalized text of the whole book, as a view of the memory map (nothing is copied)."""
+        return memoryview(self._text)[self.normalized_offsets[0]:self.normalized_offsets[-1]]
+
+
+def _index_path(key):
+    return os.path.join(PAGE_INDEX_DIRECTORY, f"{key}.json")
+
+
+def _text_path(key):
+    return os.path.join(PAGE_INDEX_DIRECTORY, f"{key}.txt")
+
+
+def _extract_pdf_pages(file_path):
+    print(f"Building page index for {file_path}")
+    reader = PdfReader(file_path)
+    raw_pages = []
+    for page in reader.pages:
+        raw_pages.append(page.extract_text() or "")
+    return raw_pages
+
+
+def _extract_epub_pages(file_path):
+    print(f"Building page index for {file_path}")
+    book = epub.read_epub(file_path)
+    raw_pages = []
+    for item_id, _ in book.spine:
+        item = book.get_item_with_id(item_id)
+        if item is None or item.get_type() != ebooklib.ITEM_DOCUMENT:
+            continue
+        # only the text of the chapter, without the html around it
+        raw_pages.append(BeautifulSoup(item.get_content(), 'html.parser').get_text())
+    return raw_pages
+
+
+def _read_page_index(key, file_path):
+    try:
+        with open(_index_path(key), 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        text_size = os.path.getsize(_text_path(key))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if data.get("version") != PAGE_INDEX_VERSION or data["normalized_offsets"][-1] != text_size:
+        return None
+    return PageTextIndex(file_path, _text_path(key), data["raw_offsets"], data["normalized_offsets"])
+
+
+def _write_page_index(key, file_path, raw_pages):
+    """
+    Writes the raw and normalized text of every page into the book's text file, and the byte
+    offsets of the pages into its index file (written last, so an index always has its text).
+    """
+    os.makedirs(PAGE_INDEX_DIRECTORY, exist_ok=True)
+    offsets = [0]
+    fd, temp_path = tempfile.mkstemp(dir=PAGE_INDEX_DIRECTORY, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for page_text in raw_pages + [normalize_page_text(page_text) for page_text in raw_pages]:
+                encoded = page_text.encode('utf-8', errors='replace')
+                f.write(encoded)
+                offsets.append(offsets[-1] + len(encoded))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, _text_path(key))
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    data = {
+        "version": PAGE_INDEX_VERSION,
+        "file_path": os.path.abspath(file_path),
+        "raw_offsets": offsets[:len(raw_pages) + 1],
+        "normalized_offsets": offsets[len(raw_pages):],
+    }
+    atomic_write_json(_index_path(key), data)
+
+
+def load_page_index(file_path):
+    """
+    Returns the page index of a PDF or EPUB. The book is only parsed the first time it is seen
+    (or after it changed); afterwards the index is served from memory or from disk.
+
+    Args:
+        file_path (str): The path to the PDF or EPUB file
+
+    Returns:
+        PageTextIndex: The raw and normalized text of every page of the book.
+    """
+    key = book_index_key(file_path)
+    if key in _loaded_indexes:
+        return _loaded_indexes[key]
+
+    index = _read_page_index(key, file_path)
+    if index is None:
+        if file_path.lower().endswith(".epub"):
+            raw_pages = _extract_epub_pages(file_path)
+        else:
+            raw_pages = _extract_pdf_pages(file_path)
+        _write_page_index(key, file_path, raw_pages)
+        index = _read_page_index(key, file_path)
+
+    _loaded_indexes[key] = index
+    return index
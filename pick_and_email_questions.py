@@ -1,12 +1,12 @@
 import json
 import os
 import random
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.image import MIMEImage
 from datetime import datetime
-from config import PROCESSED_TEXT_FILE, QUESTION_SETS_DIR
+from config import QUESTION_SETS_DIR
+from state_store import get_state_store
+from question_set_lock import question_set_lock
+from send_emails.mail_transport import send_email, get_mail_transport
+from card_rendering import CardRenderer, card_latex, render_settings, render_markdown_latex, RENDER_MODES
 import importlib
 import re
 import base64
@@ -15,58 +15,11 @@ import subprocess
 from io import BytesIO
 from PIL import Image
 import html
-import matplotlib.pyplot as plt
 import io
 
 def read_processed_files(set_name):
-    path = f"{PROCESSED_TEXT_FILE}_{set_name}.json"
-    try:
-        with open(path, 'r', encoding='utf-8') as file:
-            return json.load(file)
-    except FileNotFoundError:
-        return {}
-    except json.JSONDecodeError:
-        print(f"Error reading {path}. File might be corrupted. Starting with an empty dict.")
-        return {}
-
-# Function to send email
-def send_email(content, subject, image_dict):
-    sender_email = os.getenv("SENDER_MAIL")
-    receiver_email = os.getenv("RECEIVER_MAIL")
-    password = os.getenv("EMAIL_PASSWORD")
-
-    message = MIMEMultipart("related")
-    message["From"] = sender_email
-    message["To"] = receiver_email
-    message["Subject"] = subject
-
-    # Attach the HTML content
-    html_part = MIMEText(content, 'html')
-    message.attach(html_part)
-
-    # Attach images with Content-ID
-    for cid, image_data in image_dict.items():
-        if isinstance(image_data, str):  # It's a file path
-            with open(image_data, 'rb') as img:
-                img_data = img.read()
-            image = MIMEImage(img_data)
-            image.add_header('Content-Disposition', 'inline', filename=os.path.basename(image_data))
-        else:  # It's binary data
-            image = MIMEImage(image_data)
-            image.add_header('Content-Disposition', 'inline', filename=f'{cid}.png')
-        
-        image.add_header('Content-ID', f'<{cid}>')
-        message.attach(image)
-
-    try:
-        server = smtplib.SMTP_SSL("smtp.gmail.com", 465)
-        server.login(sender_email, password)
-        server.sendmail(sender_email, receiver_email, message.as_string())
-        print(f"Email sent successfully for {subject}!")
-    except Exception as e:
-        print(f"Failed to send email for {subject}. Error: {e}")
-    finally:
-        server.quit()
+    """Returns {question: when it was last sent} for a question set."""
+    return get_state_store().send_history(set_name)
 
 # Function to pick questions that were least recently sent
 def pick_least_recently_sent_questions(qa_pairs, processed_dict, num_questions=2):
@@ -86,39 +39,9 @@ def pick_least_recently_sent_questions(qa_pairs, processed_dict, num_questions=2
     return selected_questions
 
 def write_processed_files(processed_files, set_name):
-    path = f"{PROCESSED_TEXT_FILE}_{set_name}.json"
-    
-    # Read existing entries
-    existing_entries = read_processed_files(set_name)
-    
-    # Update timestamps for processed files
-    current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    for item in processed_files:
-        existing_entries[item] = current_time
-    
-    # Write updated entries back to the file
-    with open(path, 'w', encoding='utf-8') as file:
-        json.dump(existing_entries, file, indent=2)
-    
-    print(f"File {path} has been updated with {len(existing_entries)} entries.")
-
-# Function to render markdown and latex in HTML
-def render_markdown_latex(content):
-    import markdown2
-    import latex2mathml.converter
-
-    html_content = markdown2.markdown(content)
-
-    def replace_latex_with_mathml(match):
-        latex_code = match.group(1)
-        mathml_code = latex2mathml.converter.convert(latex_code)
-        return f'<math xmlns="http://www.w3.org/1998/Math/MathML">{mathml_code}</math>'
-
-    import re
-    html_content = re.sub(r'\$(.*?)\$', replace_latex_with_mathml, html_content)
-    html_content = re.sub(r'```(.*?)```', r'\1', html_content, flags=re.DOTALL)
-
-    return html_content
+    store = get_state_store()
+    store.record_sent(set_name, processed_files)
+    print(f"Recorded {len(processed_files)} sent questions for {set_name} in {store.path}")
 
 def format_question_in_markdown(question, answer):
     return f"# Question:\n```{question}```\n# Answer:\n```{answer}```"
@@ -138,60 +61,6 @@ def find_image_file(images_dir, filename):
             return os.path.join(root, filename)
     return None
 
-def latex_to_image(latex_content):
-    plt.figure(figsize=(10, 10))
-    plt.axis('off')
-
-    # Define custom LaTeX-like commands with a preceding space
-    def custom_latex_commands(content):
-        content = re.sub(r'\\inner\{(.+?)\}\{(.+?)\}', r' \\langle \1, \2 \\rangle', content)
-        content = re.sub(r'\\norm\{(.+?)\}', r' \\|\1\\|', content)
-        content = re.sub(r'\\complex', r' \\mathbb{C}', content)
-        content = re.sub(r'\\reals', r' \\mathbb{R}', content)
-        content = re.sub(r'\\matrixset\{(.+?)\}\{(.+?)\}', r' M_{\1}(\2)', content)
-        return content
-
-    # Handle LaTeX environments like align*, equation*, etc.
-    def handle_environments(content):
-        # Convert \begin{align*}...\end{align*} to a display math environment
-        content = re.sub(
-            r'\\begin\{align\*\}(.*?)\\end\{align\*\}', 
-            lambda m: f'\\[\n{m.group(1)}\n\\]', 
-            content, flags=re.DOTALL
-        )
-        # Convert \begin{equation*}...\end{equation*} to a display math environment
-        content = re.sub(
-            r'\\begin\{equation\*\}(.*?)\\end\{equation\*\}', 
-            lambda m: f'\\[\n{m.group(1)}\n\\]', 
-            content, flags=re.DOTALL
-        )
-        return content
-
-    def split_long_equation(match):
-        eq = match.group(1)
-        if len(eq) > 50:  # Adjust this threshold as needed
-            parts = eq.split(',')
-            return '$ ' + ' $\n$ '.join(parts) + ' $'
-        return f'${eq}$'
-
-    latex_content = custom_latex_commands(latex_content) # add custom commands
-    latex_content = handle_environments(latex_content)
-    # matplotlib breaks for some reason if there are double dollar signs
-    latex_content = re.sub(r'\$\$(.*?)\$\$', lambda m: f'\n${m.group(1)}$\n', latex_content, flags=re.DOTALL)
-
-    # latex_content = re.sub(r'\$(.+?)\$', split_long_equation, latex_content)
-
-    
-    plt.text(0.5, 0.5, latex_content, size=12, ha='center', va='center', wrap=True)
-    
-    img_buffer = io.BytesIO()
-    plt.savefig(img_buffer, format='png', bbox_inches='tight', pad_inches=0.1, dpi=300)
-    img_buffer.seek(0)
-    
-    plt.close()
-    
-    return img_buffer.getvalue()
-
 def process_latex(content):
     # Replace '\\' with '\' in the content
     content = content.replace('\\\\', '\\')
@@ -219,6 +88,8 @@ def format_question_in_latex(question, answer):
 
 def process_and_send_emails():
     question_sets_dir = QUESTION_SETS_DIR
+    # the questions of every set are picked first, so the cards of all sets are rendered together
+    digests = []
     for set_dir in os.listdir(question_sets_dir):
         set_path = os.path.join(question_sets_dir, set_dir)
         if os.path.isdir(set_path):
@@ -232,6 +103,11 @@ def process_and_send_emails():
             num_questions = config.get("num_questions", 2)
             question_algorithm = config.get("question_algorithm", "least_recently_chosen")
             paused = config.get("paused", "false")
+            render_mode = config.get("render_mode", "png")
+
+            if render_mode not in RENDER_MODES:
+                print(f"Unknown render mode {render_mode} for {internal_name}. Using png")
+                render_mode = "png"
 
             if internal_name != 'lin_alg':
                 continue
@@ -244,49 +120,88 @@ def process_and_send_emails():
 
             processed_dict = read_processed_files(internal_name)
             
-            with open(qa_pairs_file, 'r', encoding='utf-8') as file:
-                qa_pairs = json.load(file)
+            # QA pairs live in the state store; the set's json file is (re)imported whenever it was edited.
+            # The set is locked so the drive sync does not write it in between
+            store = get_state_store()
+            with question_set_lock(set_dir):
+                store.import_qa_pairs_file(set_dir, qa_pairs_file)
+                qa_pairs = store.qa_pairs(set_dir)
             
             picking_algorithm = get_picking_algorithm(question_algorithm)
             selected_questions = picking_algorithm(qa_pairs, processed_dict, num_questions)
             
             print(selected_questions)
-            content = ''
-            image_dict = {}
-            
-            for i, question in enumerate(selected_questions):
-                current_content = qa_pairs[question]
-                if keys_are_questions == "true":
-                    print(f"Processing question: {question}")
-                    print(f"Answer: {qa_pairs[question]}")
-                    latex_content = f"Question: {question}\n\nAnswer: {qa_pairs[question]}"
-                else:
-                    latex_content = current_content
-
-                latex_image = latex_to_image(latex_content)
+            digests.append({
+                "set_path": set_path,
+                "internal_name": internal_name,
+                "subject_title": subject_title,
+                "keys_are_questions": keys_are_questions,
+                "render_mode": render_mode,
+                "settings": render_settings(config),
+                "questions": [(question, qa_pairs[question]) for question in selected_questions],
+            })
+
+    # html cards only need images for the math that cannot be sent as MathML, png cards are one image
+    cards = []
+    for digest in digests:
+        digest["cards"] = []
+        for i, (question, answer) in enumerate(digest["questions"]):
+            latex_content = card_latex(question, answer, digest["keys_are_questions"])
+            if digest["render_mode"] == "html":
+                card_html, card_images = render_markdown_latex(latex_content, f"math_{i}_")
+            else:
+                card_html, card_images = None, {f"latex_img_{i}": latex_content}
+            digest["cards"].append((card_html, card_images))
+            cards.extend((latex, digest["settings"]) for latex in card_images.values())
+
+    # cards are usually rendered ahead of time, when their QA pair was generated; the others are rendered here, in parallel
+    with CardRenderer() as renderer:
+        latex_images = iter(renderer.render(cards))
+
+    for digest in digests:
+        set_path = digest["set_path"]
+        content = ''
+        image_dict = {}
+        
+        for i, (question, current_content) in enumerate(digest["questions"]):
+            if digest["keys_are_questions"] == "true":
+                print(f"Processing question: {question}")
+                print(f"Answer: {current_content}")
+            card_html, card_images = digest["cards"][i]
+            card_pngs = {cid: next(latex_images) for cid in card_images}
+
+            if card_html is not None:
+                # math that failed to render as well is shown by its alt text
+                image_dict.update({cid: png for cid, png in card_pngs.items() if png is not None})
+                content += f'{card_html}<br><br>'
+            else:
+                cid = f"latex_img_{i}"
+                latex_image = card_pngs[cid]
                 if latex_image is not None:
-                    cid = f"latex_img_{i}"
                     image_dict[cid] = latex_image
                     content += f'<img src="cid:{cid}" alt="LaTeX content"><br><br>'
                 else:
-                    content += f'<pre>{html.escape(latex_content)}</pre><br><br>'
+                    content += f'<pre>{html.escape(card_images[cid])}</pre><br><br>'
+
+            # Process [IMAGE_WORD] tags
+            parts = re.split(r'(\[IMAGE_WORD\]\(.*?\))', current_content)
+            for part in parts:
+                if part.startswith('[IMAGE_WORD]'):
+                    image_filename = re.search(r'\((.*?)\)', part).group(1)
+                    images_dir = os.path.join(set_path, "images")
+                    full_image_path = find_image_file(images_dir, image_filename)
+                    if full_image_path:
+                        cid = f"img_{len(image_dict)}"
+                        image_dict[cid] = full_image_path
+                        content += f'<img src="cid:{cid}" alt="{image_filename}"><br><br>'
+                    else:
+                        print(f"Warning: Image not found: {image_filename}")
+        
+        send_email(content, f"Question Digest: {digest['subject_title']}", image_dict)
+        write_processed_files([question for question, _ in digest["questions"]], digest["internal_name"])
 
-                # Process [IMAGE_WORD] tags
-                parts = re.split(r'(\[IMAGE_WORD\]\(.*?\))', current_content)
-                for part in parts:
-                    if part.startswith('[IMAGE_WORD]'):
-                        image_filename = re.search(r'\((.*?)\)', part).group(1)
-                        images_dir = os.path.join(set_path, "images")
-                        full_image_path = find_image_file(images_dir, image_filename)
-                        if full_image_path:
-                            cid = f"img_{len(image_dict)}"
-                            image_dict[cid] = full_image_path
-                            content += f'<img src="cid:{cid}" alt="{image_filename}"><br><br>'
-                        else:
-                            print(f"Warning: Image not found: {image_filename}")
-            
-            send_email(content, f"Question Digest: {subject_title}", image_dict)
-            write_processed_files(selected_questions, internal_name)
+    # every digest went over one connection; digests that failed with a temporary error are retried before it is closed
+    get_mail_transport().close()
 
 if __name__ == '__main__':
     process_and_send_emails()
@@ -1,21 +1,10 @@
-import json
-import openai
-from openai import OpenAI
-from config import CACHE_FILE, QUESTION_ANSWER_PAIRS_FILE
-# Load your OpenAI API key
-client = OpenAI()
+import argparse
+from concurrent.futures import as_completed
+from gpt_client import chat_completion_text, GPTWorkerPool
+from state_store import get_state_store
+from config import GPT_MAX_CONCURRENCY
 
-def generate_question_answer(highlight, context):
-    prompt = f"""
-    Highlight: {highlight}\n
-    
-    Context: {context}\n\n
-    """
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {
-                "role": "system", "content": """You will be given a highlight and context, and you will need to generate 1-3 question
+QA_SYSTEM_PROMPT = """You will be given a highlight and context, and you will need to generate 1-3 question
                  and answer pairs (depending on how many questions are required to cover all the information in the highlight) based 
             on the provided information. The fewer questions you generate, the better. The questions should be primarily knowledge questions. 
             For highlights related to math propositions / theorems / corollary, the question and answer pair
@@ -24,33 +13,68 @@ def generate_question_answer(highlight, context):
             math equations should be in latex. 
             The questions should be in the following format, in markdown format: 
             # Question:\n ```[Question]```\n # Answer:\n ```[Answer]```."""
-            },
-            {"role": "user", "content": prompt}
-        ],
-    )
-    print(response.choices[0].message.content.strip())
-    return response.choices[0].message.content.strip()
-
-# Load the highlight cache
-with open(CACHE_FILE, 'r') as file:
-    highlight_cache = json.load(file)
-
-# Load the existing question-answer pairs if they exist
-try:
-    with open(QUESTION_ANSWER_PAIRS_FILE, 'r') as file:
-        qa_pairs = json.load(file)
-except FileNotFoundError:
-    print("No existing question-answer pairs found. Creating new file.")
-    qa_pairs = {}
-
-# Iterate through each highlight-context pair and generate question-answer pairs
-for highlight, context in highlight_cache.items():
-    if highlight in qa_pairs:
-        print(f"Skipping already processed highlight: {highlight}")
-        continue
-    qa_pair = generate_question_answer(highlight, context)
-    qa_pairs[highlight] = qa_pair
-
-# Optionally, save the generated question-answer pairs to a new JSON file
-with open(QUESTION_ANSWER_PAIRS_FILE, 'w') as file:
-    json.dump(qa_pairs, file, indent=4)
+
+# model used to generate the question-answer pairs (shared with the batch mode)
+QA_MODEL = "gpt-4o-mini"
+
+def build_qa_messages(highlight, context):
+    """Returns the chat messages asking GPT for question-answer pairs about a highlight."""
+    prompt = f"""
+    Highlight: {highlight}\n
+    
+    Context: {context}\n\n
+    """
+    return [
+        {"role": "system", "content": QA_SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+
+def generate_question_answer(highlight, context):
+    qa_pair = chat_completion_text(
+        model=QA_MODEL,
+        messages=build_qa_messages(highlight, context),
+    ).strip()
+    print(qa_pair)
+    return qa_pair
+
+def generate_missing_qa_pairs(max_in_flight=GPT_MAX_CONCURRENCY):
+    """
+    Generates question-answer pairs for every highlight context that does not have any yet.
+
+    Up to max_in_flight requests run at the same time. Every result is saved as soon as it arrives,
+    so an interrupted run loses nothing and the next run only generates the missing pairs.
+
+    Args:
+        max_in_flight (int): The number of requests sent to the API at the same time
+
+    Returns:
+        int: The number of highlights QA pairs were generated for.
+    """
+    store = get_state_store()
+    missing = store.highlights_without_qa()
+    print(f"Generating question-answer pairs for {len(missing)} highlights...")
+
+    generated = 0
+    with GPTWorkerPool(max_in_flight) as pool:
+        futures = {pool.submit(generate_question_answer, highlight, context): highlight for highlight, context in missing}
+        for future in as_completed(futures):
+            highlight = futures[future]
+            try:
+                qa_pair = future.result()
+            except Exception as e:
+                print(f"Failed to generate question-answer pairs for highlight: {highlight}. Error: {e}")
+                continue
+            store.set_highlight_qa(highlight, qa_pair)
+            generated += 1
+
+    print(f"Generated question-answer pairs for {generated}/{len(missing)} highlights.")
+    return generated
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate question-answer pairs for the cached highlight contexts.")
+    parser.add_argument("--max-in-flight", type=int, default=GPT_MAX_CONCURRENCY, help="number of requests sent to the API at the same time")
+    args = parser.parse_args()
+    generate_missing_qa_pairs(args.max_in_flight)
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,38 @@
-import os
-import json
-import openai
-from openai import OpenAI
-from ebooklib import epub
-import ebooklib
-from PyPDF2 import PdfReader
-import unicodedata
-import re
-from fuzzywuzzy import fuzz
-from fuzzywuzzy import process
-from config import RELEVANT_BOOKS, CLIPPINGS_FILE_PATH, BOOKS_DIRECTORY, PROCESSED_HIGHLIGHTS_FILE, CACHE_FILE, HIGHLIGHT_CONTEXT_CHARACTER_WINDOW
-
-
-print(os.getenv("OPENAI_API_KEY"))
-openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
-def load_cache():
-    """Load the cache from the file."""
-    if os.path.exists(CACHE_FILE):
-        with open(CACHE_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {}
-
-def save_cache(cache):
-    """Save the cache to the file."""
-    with open(CACHE_FILE, 'w', encoding='utf-8') as f:
-        json.dump(cache, f, indent=4)
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pdf_page_index import load_page_index
+from book_file_index import get_book_file_index
+from clippings_parser import iter_clippings, parse_clipping, watermark_start_offset, make_watermark
+from highlight_matching import find_highlight, context_around, release_ngram_index
+from highlight_dedup import deduplicate_highlights
+from json_store import BatchedJsonFile
+from state_store import get_state_store
+from gpt_client import chat_completion_text, GPTWorkerPool
+from config import RELEVANT_BOOKS, CLIPPINGS_FILE_PATH, BOOKS_DIRECTORY, HIGHLIGHT_CONTEXT_CHARACTER_WINDOW, PAGE_OFFSETS_FILE, STATE_FLUSH_EVERY, STATE_FLUSH_SECONDS, EXTRACTION_WORKERS
+
+
+# where the last run stopped reading the clippings file
+CLIPPINGS_WATERMARK_KEY = "clippings_watermark"
+
+# learned page offsets of every book, kept in memory and written back in batches
+_page_offsets = None
+
+# model and prompt used to clean the contexts (shared with the batch mode)
+CLEANING_MODEL = "gpt-4o-mini"
+
+def build_cleaning_messages(context):
+    """Returns the chat messages asking GPT to clean the extracted context of a highlight."""
+    # prompt = f"Please clean the following text, fixing formatting issues, and making it clear and readable:\n\n{context}"
+    prompt = f"""
+            The following consists of extracted text from a pdf using python. It is very messy. I want you to clean it up. Convert any mathematical expressions into latex and wrap code snippets around markdown blocks.
+            Do not say anything else apart from the cleaned text:
+            \n\n
+            {context}
+            """
+    return [
+        {"role": "user", "content": prompt},
+    ]
 
 def clean_text_with_gpt(context):
     """
@@ -37,94 +44,85 @@ def clean_text_with_gpt(context):
     Returns:
         str: The cleaned text.
     """
-    # prompt = f"Please clean the following text, fixing formatting issues, and making it clear and readable:\n\n{context}"
-    prompt = f"""
-            The following consists of extracted text from a pdf using python. It is very messy. I want you to clean it up. Convert any mathematical expressions into latex and wrap code snippets around markdown blocks.
-            Do not say anything else apart from the cleaned text:
-            \n\n
-            {context}
-            """
-    
-    response = openai_client.chat.completions.create(
-    model="gpt-4o-mini",
-    messages=[
-        {"role": "user", "content": prompt},
-    ]
+    # rate limited and retried on 429/5xx, so it is safe to call from several threads at once.
+    # The same context (eg: from another edition of the book) is only cleaned once.
+    cleaned_text = chat_completion_text(
+        model=CLEANING_MODEL,
+        messages=build_cleaning_messages(context)
     )
 
     print("CLEANING GPT RESPONSE \n ---------------- \n")
-    print(response)
-    
-    cleaned_text = response.choices[0].message.content
+    print(cleaned_text)
+
     return cleaned_text
 
-# Load processed highlights
-def load_processed_highlights():
-    if os.path.exists(PROCESSED_HIGHLIGHTS_FILE):
-        with open(PROCESSED_HIGHLIGHTS_FILE, 'r', encoding='utf-8') as file:
-            return json.load(file)
-    print("No processed highlights json file found! Will create one.")
-    return {}
+# Load the learned page offsets of every book (only once per run)
+def load_page_offsets():
+    global _page_offsets
+    if _page_offsets is None:
+        _page_offsets = BatchedJsonFile(PAGE_OFFSETS_FILE, flush_every=STATE_FLUSH_EVERY, flush_seconds=STATE_FLUSH_SECONDS, indent=4)
+    return _page_offsets
+
+# Save the learned page offsets of every book
+def save_page_offsets(page_offsets):
+    page_offsets.flush()
 
-# Save processed highlights
-def save_processed_highlights(processed_highlights):
-    with open(PROCESSED_HIGHLIGHTS_FILE, 'w', encoding='utf-8') as file:
-        json.dump(processed_highlights, file, indent=4)
+# Kindle reports the pages of a pdf starting from 1, so page N is usually at index N - 1
+DEFAULT_PAGE_OFFSET = -1
 
-def normalize_text(text):
+def get_page_offset(page_offsets, book_name):
     """
-    Normalize the text to remove special characters and hidden expressions.
+    Returns the most commonly observed offset between the page numbers kindle reports
+    for a book and the page indices of its PDF.
     """
-    text = unicodedata.normalize('NFKD', text)
-    text = text.encode('ascii', 'ignore').decode('ascii')
-    return text.lower().strip()
+    observed_offsets = page_offsets.get(book_name)
+    if not observed_offsets:
+        return DEFAULT_PAGE_OFFSET
+    return int(max(observed_offsets, key=observed_offsets.get))
+
+def record_page_offset(page_offsets, book_name, offset):
+    """Counts an offset that was confirmed by a match of a highlight on its page."""
+    observed_offsets = page_offsets.setdefault(book_name, {})
+    observed_offsets[str(offset)] = observed_offsets.get(str(offset), 0) + 1
+    page_offsets.mark_dirty()
 
 def find_book_file(book_title):
     """
     Automatically locates the file path of a book based on its title within the BOOKS_DIRECTORY.
+    The directory is indexed once (and again whenever its contents change).
     """
-    normalized_book_title = normalize_text(book_title)
-    if (normalized_book_title != book_title):
-        return None # return None if the title has special characters
-    
-    for file in os.listdir(BOOKS_DIRECTORY):
-        normalized_file_name = normalize_text(file)
-        if normalized_book_title in normalized_file_name and file.endswith(('.epub', '.pdf')):
-            return os.path.join(BOOKS_DIRECTORY, file)
-    
-    return None
+    return get_book_file_index(BOOKS_DIRECTORY).find(book_title)
 
-def extract_highlights_from_clippings(clippings_file):
-    highlights = {}
-    with open(clippings_file, 'r', encoding='utf-8') as file:
-        content = file.read()
+def _is_relevant_highlight(book_title, highlight):
+    # Check if the book is in the relevant books list;
+    # If RELEVANT_BOOKS is empty, all books will be processed
+    return (any(relevant_book.lower() in book_title.lower() for relevant_book in RELEVANT_BOOKS) or RELEVANT_BOOKS == []) and len(highlight) > 3
 
-    entries = content.split("==========")
-    for entry in entries:
-        lines = entry.strip().split('\n')
-        if len(lines) < 3:
-            continue
+def extract_new_highlights_from_clippings(clippings_file, watermark=None):
+    """
+    Extracts the highlights added to the clippings file since the watermark was taken.
+    Kindle only ever appends to the file, so reading starts right after the last entry seen before;
+    the whole file is only read again if it was truncated or rewritten.
+
+    Args:
+        clippings_file (str): The path to My Clippings.txt
+        watermark (dict): The watermark returned by an earlier call (None reads the whole file)
 
-        # Skip entries that are not highlights
-        if "Note" in lines[1] or "Bookmark" in lines[1]:
+    Returns:
+        tuple: ({book_title: [{"highlight", "page_number"}, ...]}, watermark after the last entry read)
+    """
+    highlights = {}
+    start_offset = watermark_start_offset(clippings_file, watermark)
+    new_watermark = watermark if start_offset else None
+
+    for entry, entry_start, entry_end in iter_clippings(clippings_file, start_offset):
+        new_watermark = make_watermark(clippings_file, entry, entry_start, entry_end)
+        clipping = parse_clipping(entry)
+        if clipping is None:
             continue
 
-        book_title = lines[0].strip()
-        highlight = lines[-1].strip()
-
-        # Extract page number if available
-        page_number = None
-        for line in lines:
-            if "Your Highlight on page" in line:
-                # Extract page number(s) from the line
-                page_number_match = re.search(r'page\s+(\d+)(?:-\d+)?', line)
-                if page_number_match:
-                    page_number = int(page_number_match.group(1))
-                break
-
-        # Check if the book is in the relevant books list;
-        # If RELEVANT_BOOKS is empty, all books will be processed
-        if (any(relevant_book.lower() in book_title.lower() for relevant_book in RELEVANT_BOOKS) or RELEVANT_BOOKS == []) and len(highlight) > 3:
+        book_title, highlight, page_number = clipping
+        if _is_relevant_highlight(book_title, highlight):
             if book_title not in highlights:
                 highlights[book_title] = []
             highlights[book_title].append({
@@ -132,23 +130,117 @@ def extract_highlights_from_clippings(clippings_file):
                 "page_number": page_number
             })
 
+    return highlights, new_watermark
+
+def extract_highlights_from_clippings(clippings_file):
+    highlights, _ = extract_new_highlights_from_clippings(clippings_file)
     return highlights
 
 def extract_context_from_epub(file_path, highlight_text):
-    book = epub.read_epub(file_path)
-    context = ""
-    for item in book.get_items():
-        if item.get_type() == ebooklib.ITEM_DOCUMENT:
-            content = item.get_content().decode('utf-8')
-            if highlight_text in content:
-                start_index = max(0, content.index(highlight_text) - 500)
-                end_index = min(len(content), content.index(highlight_text) + len(highlight_text) + 500)
-                context = content[start_index:end_index]
-                break
-    print(context)
+    """
+    Extracts the raw context around a highlight in an EPUB file, searching the text of its
+    chapters (parsed only once per book) the same way highlights are searched in PDFs.
+    """
     print("EXTRACTING CONTEXT FROM EPUB FOR HIGHLIGHT: ", highlight_text)
+    context, _ = find_context(load_page_index(file_path), highlight_text, None, DEFAULT_PAGE_OFFSET)
+    return context or ""
+
+# The books contexts can be extracted from
+SUPPORTED_BOOK_FORMATS = (".pdf", ".epub")
+
+def reported_page_number(file_path, page_number):
+    """
+    The page number kindle reported for a highlight, if it can be used to look it up in the book.
+    The pages of an EPUB index are its chapters, which have nothing to do with kindle's page numbers.
+    """
+    return page_number if file_path.endswith(".pdf") else None
+
+def find_context(page_index, highlight_text, page_number, offset):
+    """
+    Finds a highlight in the page index of a book and returns the raw text around it, without cleaning it.
+
+    Args:
+        page_index (PageTextIndex): The extracted text of the book
+        highlight_text (str): The highlight text to search for
+        page_number (int): The page number kindle reported for the highlight
+        offset (int): The offset between the reported page numbers and the page indices of the book
+
+    Returns:
+        tuple: (raw context, HighlightMatch), or (None, None) if the highlight is not found.
+    """
+    highlight_text = highlight_text.replace("\n", "")
+
+    # Start at the page kindle reported and only fall back to the rest of the book if needed
+    match = find_highlight(page_index, highlight_text, page_number, offset)
+
+    if match is None:
+        print("DID NOT FIND CONTEXT FOR THE ABOVE HIGHLIGHT!")
+        return None, None
+
+    print(f"Found highlight on page index {match.page_index} (score {match.score:.0f})")
+
+    # Extract the context around the found match
+    return context_around(page_index, match, HIGHLIGHT_CONTEXT_CHARACTER_WINDOW).replace("\n", ""), match
+
+def locate_context_in_pdf(file_path, highlight_text, page_number, book_name):
+    """
+    Finds a highlight in a PDF (or EPUB) and returns the raw text around it, without cleaning it.
+
+    Args:
+        file_path (str): The path to the PDF or EPUB file
+        highlight_text (str): The highlight text to search for
+        page_number (int): The page number kindle reported for the highlight
+        book_name (str): The name of the book (used for page offset)
+
+    Returns:
+        str: The raw context around the highlight, or None if the highlight is not found.
+    """
+    page_index = load_page_index(file_path)  # Parsed only once per book
+    page_number = reported_page_number(file_path, page_number)
+    page_offsets = load_page_offsets()
+    context, match = find_context(page_index, highlight_text, page_number, get_page_offset(page_offsets, book_name))
+
+    # Remember where the reported page numbers of this book are in the pdf
+    if match is not None and page_number is not None:
+        record_page_offset(page_offsets, book_name, match.page_index - page_number)
+
     return context
 
+def extract_book_contexts(file_path, book_name, entries, observed_offsets):
+    """
+    Finds every highlight of one book in its PDF or EPUB. Runs in an extraction worker process, so it
+    does not touch the state store or the page offsets file; the main process stores what it returns.
+
+    Args:
+        file_path (str): The path to the PDF or EPUB file
+        book_name (str): The name of the book (used for page offset)
+        entries (list): The {"highlight", "page_number"} entries to find
+        observed_offsets (dict): The offsets learned for the book so far
+
+    Returns:
+        tuple: ([raw context or None for every entry], [page offsets confirmed by the matches])
+    """
+    page_index = load_page_index(file_path)  # Parsed only once per book
+    page_offsets = {book_name: dict(observed_offsets)}
+    contexts = []
+    confirmed_offsets = []
+    for entry in entries:
+        print("EXTRACTING CONTEXT FOR HIGHLIGHT: ", entry["highlight"])
+        page_number = reported_page_number(file_path, entry["page_number"])
+        offset = get_page_offset(page_offsets, book_name)
+        context, match = find_context(page_index, entry["highlight"], page_number, offset)
+        contexts.append(context)
+
+        # later highlights of the book already start at the offsets confirmed by earlier ones
+        if match is not None and page_number is not None:
+            confirmed_offset = match.page_index - page_number
+            confirmed_offsets.append(confirmed_offset)
+            page_offsets[book_name][str(confirmed_offset)] = page_offsets[book_name].get(str(confirmed_offset), 0) + 1
+
+    # the worker goes on with another book
+    release_ngram_index()
+    return contexts, confirmed_offsets
+
 def extract_context_from_pdf(file_path, highlight_text, page_number, book_name):
     """
     Extracts the context from a specific page in a PDF file around a given highlight,
@@ -164,110 +256,204 @@ def extract_context_from_pdf(file_path, highlight_text, page_number, book_name):
     Returns:
         str: The cleaned context around the highlight, or an empty string if the highlight is not found.
     """
-    # Load the cache
-    cache = load_cache()
+    store = get_state_store()
     print("EXTRACTING CONTEXT FROM PDF FOR HIGHLIGHT: ", highlight_text)
 
     # Check if the highlight is already cached
-    if highlight_text in cache:
+    cached_context = store.get_context(highlight_text.replace("\n", ""))
+    if cached_context is not None:
         print("Using cached version")
-        return cache[highlight_text]
+        return cached_context
 
-    reader = PdfReader(file_path)  # Read the PDF file
-    context = ""  # Initialize the context string
-    highlight_text = highlight_text.replace("\n", "")
+    context = locate_context_in_pdf(file_path, highlight_text, page_number, book_name)
+    if context is None:
+        return ""
 
-    # Adjust page_number to be zero-indexed
-    for page_index in range(len(reader.pages)):
-        page = reader.pages[page_index]
-        page_text = page.extract_text()  # Extract the text from the page
+    # Clean the context using GPT-4
+    cleaned_context = clean_text_with_gpt(context)
 
-        # print(OFFSETS_BY_BOOK_NAME[book_name])
+    # Store the cleaned context in the cache
+    store.set_context(highlight_text.replace("\n", ""), cleaned_context)
 
-        if page_index < 0 or page_index >= len(reader.pages):
-            print(f"Page number {page_number} is out of range in the PDF.")
-            return context
- 
-        if page_text:
-            page_text = page_text.replace("\n", "")
-            
-            page_text_cleaned = page_text.replace("\n", "").replace(" ", "").lower()
+    return cleaned_context
 
-            # check if strings are approximately equal
-            # sometimes the strings in highlights are different than the pdf (eg: "field" in pdf -> "feld" in highlight)
-            if fuzz.partial_ratio(highlight_text.replace(" ", "").lower(), page_text_cleaned) > 80:
-                print("PASSED PARTIAL RATION")
 
-                match_start = process.extractOne(highlight_text, [page_text_cleaned], scorer=fuzz.partial_ratio)[1]
+def _write_finished_contexts(store, pending, wait=False):
+    """
+    Stores the cleaned contexts of the pending highlights, in the order the highlights were queued.
+    Stops at the first highlight whose cleaning is still running, unless wait is set.
 
-                # Extract the context around the found match
-                start_index = max(0, match_start - HIGHLIGHT_CONTEXT_CHARACTER_WINDOW)
-                end_index = min(len(page_text), match_start + len(highlight_text) + HIGHLIGHT_CONTEXT_CHARACTER_WINDOW)
-                context = page_text[start_index:end_index]
+    Returns:
+        int: The number of highlights whose cleaning failed (they are not marked as processed)
+    """
+    failed = 0
+    while pending and (wait or pending[0]["future"] is None or pending[0]["future"].done()):
+        item = pending.popleft()
+        if item["future"] is not None:
+            try:
+                item["context"] = item["future"].result()
+            except Exception as e:
+                print(f"Failed to clean the context of highlight: {item['highlight']}. Error: {e}")
+                failed += 1
+                continue
+            store.set_context(item["highlight"].replace("\n", ""), item["context"])
 
-                # Clean the context using GPT-4
-                cleaned_context = clean_text_with_gpt(context)
+        # Mark the highlight as processed
+        store.add_processed_highlight(item["book_title"], item["highlight"], item["page_number"])
+    return failed
 
-                # Store the cleaned context in the cache
-                cache[highlight_text] = cleaned_context
-                save_cache(cache)
 
-                return cleaned_context
+def _extract_books(books, workers):
+    """
+    Finds the highlights of every book, one book per extraction worker process, and yields
+    (book, result of extract_book_contexts) as the books finish. A book that failed yields None.
+    """
+    page_offsets = load_page_offsets()
+    if workers <= 1 or len(books) <= 1:
+        for book in books:
+            try:
+                yield book, extract_book_contexts(book["file_path"], book["book_name"], book["entries"], page_offsets.get(book["book_name"], {}))
+            except Exception as e:
+                print(f"Failed to extract the highlights of the book: {book['book_name']}. Error: {e}")
+                yield book, None
+        return
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(books))) as pool:
+        futures = {
+            pool.submit(extract_book_contexts, book["file_path"], book["book_name"], book["entries"], page_offsets.get(book["book_name"], {})): book
+            for book in books
+        }
+        for future in as_completed(futures):
+            book = futures[future]
+            try:
+                yield book, future.result()
+            except Exception as e:
+                print(f"Failed to extract the highlights of the book: {book['book_name']}. Error: {e}")
+                yield book, None
+
+
+def _with_pending_highlights(pending_highlights, highlights):
+    """
+    Puts the highlights earlier runs could not process (see StateStore.pending_highlights) before
+    the highlights read from the clippings file, book by book.
+    """
+    merged = {book_name: list(entries) for book_name, entries in pending_highlights.items()}
+    for book_title, entries in highlights.items():
+        merged.setdefault(book_title, []).extend(entries)
+    return merged
 
-    print("DID NOT FIND CONTEXT FOR THE ABOVE HIGHLIGHT!")
-    return context
 
+def process_books(full_rescan=False, workers=EXTRACTION_WORKERS):
+    """
+    Finds the context of every highlight and cleans it with GPT.
 
-def process_books():
-    processed_highlights = load_processed_highlights()
-    highlights = extract_highlights_from_clippings(CLIPPINGS_FILE_PATH)
+    The highlights of each book are found in its PDF or EPUB by a separate extraction process (up to
+    `workers` books at a time), and the contexts found are cleaned by a pool of GPT workers
+    (GPT_MAX_CONCURRENCY requests in flight) as soon as their book is done. The main process
+    stores the results, in the order of the highlights of each book.
 
+    Only highlights added to the clippings file since the last run are processed, unless
+    full_rescan is set, along with the highlights of earlier runs whose book had no file then.
+    """
+    store = get_state_store()
+    watermark = None if full_rescan else store.get_meta(CLIPPINGS_WATERMARK_KEY)
+    highlights, new_watermark = extract_new_highlights_from_clippings(CLIPPINGS_FILE_PATH, watermark)
+    highlights = _with_pending_highlights(store.pending_highlights(), highlights)
+    page_offsets = load_page_offsets()
+
+    # Highlights that already have a context are done right away, the rest are found per book
+    books = []
     for book_title, book_highlights in highlights.items():
         print(f"Processing book: {book_title}")
-        
+
         # Automatically find the book file (either .epub or .pdf)
         book_file_path = find_book_file(book_title)
-        
+
+        # the watermark moves past these highlights: they are kept until the book is added
         if not book_file_path:
-            print(f"Could not find a file for the book: {book_title}")
+            print(f"Could not find a file for the book: {book_title}; its highlights are kept for the next runs")
+            store.add_pending_highlights(book_title, book_highlights)
             continue
 
-        # Ensure the book is in the processed highlights record
-        cleaned_book_title = book_title.lstrip('\ufeff')
-        if cleaned_book_title not in processed_highlights:
-            
-            processed_highlights[cleaned_book_title] = []
+        if not book_file_path.endswith(SUPPORTED_BOOK_FORMATS):
+            print(f"Unsupported file format for book: {book_title}; its highlights are kept for the next runs")
+            store.add_pending_highlights(book_title, book_highlights)
+            continue
 
-        # Determine the file format and extract context accordingly
-        for entry in book_highlights:
-            highlight = entry["highlight"]
-            page_number = entry["page_number"]
-            context = None 
-
-            # if highlight in processed_highlights[book_title]:
-            #     print(f"Skipping already processed highlight: {highlight}")
-            #     continue
-
-            if book_file_path.endswith(".epub"):
-                print("Skipping .epub for now")
-                # context = extract_context_from_epub(book_file_path, highlight)
-            elif book_file_path.endswith(".pdf"):
-                context = extract_context_from_pdf(book_file_path, highlight, page_number, book_title)
-                # print("SKIPPING PDF FOR NOW")
-            else:
-                print(f"Unsupported file format for book: {book_title}")
-                continue
+        # a broken file fails the same way every run: it is only tried again once it changed
+        if not full_rescan and store.is_failed_book(book_file_path):
+            print(f"Skipping book whose file failed before and did not change: {book_file_path}; its highlights are kept for the next runs")
+            store.add_pending_highlights(book_title, book_highlights)
+            continue
 
-            if context is not None:
-                # questions = generate_questions(context, highlight)
-                # print(f"Generated questions for highlight: {highlight}\n{questions}\n")
+        book_title_without_bom = book_title.lstrip('\ufeff')
+        entries = []
+        # overlapping and extended highlights of the same passage share one context and one GPT call
+        # (including the ones processed by earlier runs: kindle adds an extended highlight as a new entry)
+        processed_highlights = store.processed_highlights(book_title_without_bom)
+        for entry in deduplicate_highlights(book_highlights, processed_highlights):
+            highlight = entry["highlight"]
+            if entry["duplicates"]:
+                print(f"Merged {len(entry['duplicates'])} overlapping highlights into: {highlight}")
+                store.link_duplicate_highlights(book_title_without_bom, highlight, entry["duplicates"])
 
-                # Mark the highlight as processed
-                book_title_without_bom = book_title.lstrip('\ufeff')
-                processed_highlights[book_title_without_bom].append(highlight)
+            if entry["processed"] or store.is_processed_highlight(book_title_without_bom, highlight):
+                print(f"Skipping already processed highlight: {highlight}")
+                continue
 
-                # Save the updated processed highlights
-                save_processed_highlights(processed_highlights)
+            if store.get_context(highlight.replace("\n", "")) is not None:
+                print(f"Using cached version of highlight: {highlight}")
+                store.add_processed_highlight(book_title_without_bom, highlight, entry["page_number"])
+            else:
+                entries.append(entry)
+
+        if entries:
+            books.append({"book_name": book_title, "book_title": book_title_without_bom, "file_path": book_file_path, "entries": entries})
+
+    failed_books = 0
+    failed_highlights = 0
+    pending = deque()
+    with GPTWorkerPool() as gpt_pool:
+        for book, result in _extract_books(books, workers):
+            if result is None:
+                # kept (and not read again from the clippings file) until the file changes
+                failed_books += 1
+                store.record_failed_book(book["file_path"])
+                store.add_pending_highlights(book["book_name"], book["entries"])
+                continue
+            store.clear_failed_book(book["file_path"])
+            contexts, confirmed_offsets = result
+
+            # Remember where the reported page numbers of this book are in the pdf
+            for offset in confirmed_offsets:
+                record_page_offset(page_offsets, book["book_name"], offset)
+
+            for entry, context in zip(book["entries"], contexts):
+                item = {"book_title": book["book_title"], "highlight": entry["highlight"], "page_number": entry["page_number"], "context": None, "future": None}
+                if context is None:
+                    item["context"] = ""
+                else:
+                    # cleaned in the background while the other books are searched
+                    item["future"] = gpt_pool.submit(clean_text_with_gpt, context)
+                pending.append(item)
+            failed_highlights += _write_finished_contexts(store, pending)
+
+        failed_highlights += _write_finished_contexts(store, pending, wait=True)
+
+    # Write whatever is still pending (this also happens at exit if the run is interrupted)
+    save_page_offsets(page_offsets)
+
+    # only now that every highlight was handled, the next run can start after them
+    if failed_books:
+        print(f"{failed_books} books failed; their highlights are tried again once their file changes (or with --full-rescan).")
+    if failed_highlights:
+        print(f"{failed_highlights} highlights failed; they are read again by the next run.")
+    elif new_watermark is not None:
+        store.set_meta(CLIPPINGS_WATERMARK_KEY, new_watermark)
 
 if __name__ == "__main__":
-    process_books()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Find the context of kindle highlights and clean it with GPT.")
+    parser.add_argument("--full-rescan", action="store_true", help="read the whole clippings file instead of only the entries added since the last run")
+    parser.add_argument("--workers", type=int, default=EXTRACTION_WORKERS, help=f"books searched at the same time, each in its own process (default: {EXTRACTION_WORKERS})")
+    args = parser.parse_args()
+    process_books(full_rescan=args.full_rescan, workers=args.workers)
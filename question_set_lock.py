@@ -0,0 +1,50 @@
+import os
+import time
+from contextlib import contextmanager
+from config import QUESTION_SET_LOCK_DIRECTORY
+
+try:
+    import fcntl
+except ImportError:
+    # windows (the kindle pipeline runs there): msvcrt byte range locks instead of flock
+    fcntl = None
+    import msvcrt
+
+# how often a blocked msvcrt lock is tried again (msvcrt.locking gives up after 10 tries of its own)
+LOCK_RETRY_SECONDS = 0.1
+
+
+def _lock(lock_file):
+    if fcntl is not None:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return
+    lock_file.seek(0)
+    while True:
+        try:
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+            return
+        except OSError:
+            time.sleep(LOCK_RETRY_SECONDS)
+
+
+def _unlock(lock_file):
+    if fcntl is not None:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return
+    lock_file.seek(0)
+    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def question_set_lock(question_set):
+    """
+    Exclusive lock of a question set, shared by every process (the drive sync writing its QA pairs,
+    the emailer importing and reading them). Held on a lock file in QUESTION_SET_LOCK_DIRECTORY.
+    """
+    os.makedirs(QUESTION_SET_LOCK_DIRECTORY, exist_ok=True)
+    with open(os.path.join(QUESTION_SET_LOCK_DIRECTORY, f"{question_set}.lock"), 'a') as lock_file:
+        _lock(lock_file)
+        try:
+            yield
+        finally:
+            _unlock(lock_file)
@@ -0,0 +1,209 @@
+import os
+import time
+import atexit
+import smtplib
+import threading
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.mime.image import MIMEImage
+from config import SMTP_HOST, SMTP_PORT, SMTP_SSL, SMTP_TIMEOUT_SECONDS, SMTP_MAX_RETRIES
+
+
+def build_message(content, subject, image_dict, sender_email, receiver_email):
+    """
+    Builds an html email with inline images.
+
+    Args:
+        content (str): The html of the email, referring to the images as cid:<content id>
+        subject (str): The subject of the email
+        image_dict (dict): {content id: path of an image file, or the bytes of a png}
+        sender_email (str): The address the email is sent from
+        receiver_email (str): The address the email is sent to
+
+    Returns:
+        MIMEMultipart: The email
+    """
+    message = MIMEMultipart("related")
+    message["From"] = sender_email
+    message["To"] = receiver_email
+    message["Subject"] = subject
+
+    # Attach the HTML content
+    html_part = MIMEText(content, 'html')
+    message.attach(html_part)
+
+    # Attach images with Content-ID
+    for cid, image_data in image_dict.items():
+        if isinstance(image_data, str):  # It's a file path
+            with open(image_data, 'rb') as img:
+                img_data = img.read()
+            image = MIMEImage(img_data)
+            image.add_header('Content-Disposition', 'inline', filename=os.path.basename(image_data))
+        else:  # It's binary data
+            image = MIMEImage(image_data)
+            image.add_header('Content-Disposition', 'inline', filename=f'{cid}.png')
+
+        image.add_header('Content-ID', f'<{cid}>')
+        message.attach(image)
+    return message
+
+
+def is_transient_error(error):
+    """Whether sending again (on a new connection) can fix an SMTP error: dropped connections and 4xx replies."""
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPException):
+        # refused recipients, unsupported commands: the same email fails again
+        return False
+    return isinstance(error, OSError)
+
+
+class MailTransport:
+    """
+    Sends emails over one authenticated SMTP connection, opened by the first email and reused by
+    the ones after it (one TLS handshake and login per run instead of one per email). A dropped
+    connection is opened again; emails that still fail with a transient error are queued and
+    retried by flush(), at most max_retries times.
+    """
+
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, use_ssl=SMTP_SSL, sender_email=None, password=None,
+                 timeout=SMTP_TIMEOUT_SECONDS, max_retries=SMTP_MAX_RETRIES):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.sender_email = sender_email or os.getenv("SENDER_MAIL")
+        self.password = password if password is not None else os.getenv("EMAIL_PASSWORD")
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.connections_opened = 0
+        self._server = None
+        self._queue = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self.use_ssl:
+            server = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+        else:
+            server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            server.ehlo()
+            if server.has_extn('starttls'):
+                server.starttls()
+                server.ehlo()
+        try:
+            # local test servers usually take emails without logging in
+            if self.password:
+                server.login(self.sender_email, self.password)
+        except Exception:
+            server.close()
+            raise
+        self.connections_opened += 1
+        self._server = server
+
+    def _disconnect(self):
+        if self._server is None:
+            return
+        try:
+            self._server.quit()
+        except OSError:
+            # smtplib's errors are OSErrors too; a broken connection is closed either way
+            pass
+        finally:
+            self._server.close()
+            self._server = None
+
+    def _send_once(self, message):
+        """Sends an email on the open connection, opening a new one if there is none or it was dropped."""
+        if self._server is None:
+            self._connect()
+        try:
+            self._server.send_message(message)
+        except smtplib.SMTPServerDisconnected:
+            # the server closed the idle connection (or it broke): one more try on a new connection
+            self._server = None
+            self._connect()
+            self._server.send_message(message)
+
+    def send(self, message):
+        """
+        Sends an email. If it fails with a transient error it is queued for flush().
+
+        Returns:
+            bool: Whether the email was sent now
+        """
+        with self._lock:
+            try:
+                self._send_once(message)
+                print(f"Email sent successfully for {message['Subject']}!")
+                return True
+            except Exception as e:
+                self._disconnect()
+                if is_transient_error(e) and self.max_retries > 0:
+                    print(f"Failed to send email for {message['Subject']}, retrying it later. Error: {e}")
+                    self._queue.append(message)
+                else:
+                    print(f"Failed to send email for {message['Subject']}. Error: {e}")
+                return False
+
+    def flush(self):
+        """
+        Retries the queued emails (backing off between rounds) until they are sent, fail with a
+        permanent error, or were retried max_retries times.
+
+        Returns:
+            int: The number of emails that could not be sent
+        """
+        with self._lock:
+            failed = 0
+            for attempt in range(1, self.max_retries + 1):
+                if not self._queue:
+                    break
+                time.sleep(2 ** (attempt - 1))
+                queue, self._queue = self._queue, []
+                for message in queue:
+                    try:
+                        self._send_once(message)
+                        print(f"Email sent successfully for {message['Subject']}!")
+                    except Exception as e:
+                        self._disconnect()
+                        if is_transient_error(e) and attempt < self.max_retries:
+                            self._queue.append(message)
+                        else:
+                            print(f"Failed to send email for {message['Subject']} after {attempt} retries. Error: {e}")
+                            failed += 1
+            return failed
+
+    def close(self):
+        """Retries the queued emails, then closes the connection (the next email opens a new one)."""
+        failed = self.flush()
+        with self._lock:
+            self._disconnect()
+        return failed
+
+
+_mail_transport = None
+_mail_transport_lock = threading.Lock()
+
+
+def get_mail_transport():
+    """Returns the mail transport shared by this process (closed at exit, sending what is still queued)."""
+    global _mail_transport
+    with _mail_transport_lock:
+        if _mail_transport is None:
+            _mail_transport = MailTransport()
+            atexit.register(_mail_transport.close)
+        return _mail_transport
+
+
+def send_email(content, subject, image_dict):
+    """
+    Sends an html email with inline images (see build_message) from SENDER_MAIL to RECEIVER_MAIL
+    through the shared mail transport.
+
+    Returns:
+        bool: Whether the email was sent now (if not, it may be queued for a retry)
+    """
+    transport = get_mail_transport()
+    message = build_message(content, subject, image_dict, transport.sender_email, os.getenv("RECEIVER_MAIL"))
+    return transport.send(message)
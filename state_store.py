@@ -0,0 +1,475 @@
+import os
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from config import STATE_DB_FILE, CACHE_FILE, PROCESSED_HIGHLIGHTS_FILE, QUESTION_ANSWER_PAIRS_FILE, PROCESSED_TEXT_FILE, QUESTION_SETS_DIR
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS processed_highlights (
+    book TEXT NOT NULL,
+    highlight TEXT NOT NULL,
+    page_number INTEGER,
+    PRIMARY KEY (book, highlight)
+);
+CREATE TABLE IF NOT EXISTS pending_highlights (
+    book TEXT NOT NULL,
+    highlight TEXT NOT NULL,
+    book_name TEXT NOT NULL,
+    page_number INTEGER,
+    PRIMARY KEY (book, highlight)
+);
+CREATE TABLE IF NOT EXISTS failed_books (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    failed_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS highlight_duplicates (
+    book TEXT NOT NULL,
+    highlight TEXT NOT NULL,
+    canonical TEXT NOT NULL,
+    PRIMARY KEY (book, highlight)
+);
+CREATE TABLE IF NOT EXISTS highlight_contexts (
+    highlight TEXT PRIMARY KEY,
+    context TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS highlight_qa_pairs (
+    highlight TEXT PRIMARY KEY,
+    qa TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS qa_pairs (
+    question_set TEXT NOT NULL,
+    question TEXT NOT NULL,
+    answer TEXT NOT NULL,
+    PRIMARY KEY (question_set, question)
+);
+CREATE TABLE IF NOT EXISTS send_history (
+    question_set TEXT NOT NULL,
+    question TEXT NOT NULL,
+    sent_at TEXT NOT NULL,
+    PRIMARY KEY (question_set, question)
+);
+CREATE INDEX IF NOT EXISTS send_history_sent_at ON send_history (question_set, sent_at);
+CREATE TABLE IF NOT EXISTS batch_jobs (
+    job_id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    requests_file TEXT NOT NULL,
+    input_file_id TEXT,
+    batch_id TEXT,
+    status TEXT NOT NULL,
+    output_file_id TEXT,
+    error_file_id TEXT,
+    created_at TEXT NOT NULL,
+    merged_at TEXT
+);
+CREATE TABLE IF NOT EXISTS batch_requests (
+    job_id TEXT NOT NULL,
+    custom_id TEXT NOT NULL,
+    highlight TEXT NOT NULL,
+    book TEXT,
+    PRIMARY KEY (job_id, custom_id)
+);
+CREATE INDEX IF NOT EXISTS batch_requests_highlight ON batch_requests (highlight);
+CREATE TABLE IF NOT EXISTS drive_files (
+    file_id TEXT PRIMARY KEY,
+    file TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS drive_manifest (
+    file_id TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    md5_checksum TEXT,
+    modified_time TEXT NOT NULL,
+    content_hash TEXT,
+    processed_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS imported_files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+"""
+
+SENT_AT_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class StateStore:
+    """
+    All state of the pipelines (processed highlights, highlight contexts, generated QA pairs and
+    when each question was last sent) in a single SQLite database.
+
+    Every change is a small upsert instead of a rewrite of a whole json file. The store is shared
+    between threads; writes are serialized by a lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._lock = threading.RLock()
+        with self._lock:
+            # WAL keeps readers (eg: the emailer) working while a pipeline writes
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+            self._add_missing_columns()
+
+    def _add_missing_columns(self):
+        """Adds the columns that were added to existing tables after a database was created."""
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(processed_highlights)")}
+        if "page_number" not in columns:
+            # highlights processed before have no page number; they are not merged with later ones
+            self._conn.execute("ALTER TABLE processed_highlights ADD COLUMN page_number INTEGER")
+            self._conn.commit()
+
+    @contextmanager
+    def transaction(self):
+        """Groups several writes into one transaction (committed at the end, rolled back on errors)."""
+        with self._lock:
+            with self._conn:
+                yield self._conn
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # Small json values (watermarks, tokens, ...)
+    def get_meta(self, key, default=None):
+        rows = self._query("SELECT value FROM meta WHERE key = ?", (key,))
+        return json.loads(rows[0][0]) if rows else default
+
+    def set_meta(self, key, value):
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                (key, json.dumps(value))
+            )
+
+    # Processed highlights
+    def add_processed_highlight(self, book, highlight, page_number=None):
+        with self.transaction() as conn:
+            conn.execute("INSERT OR IGNORE INTO processed_highlights (book, highlight, page_number) VALUES (?, ?, ?)", (book, highlight, page_number))
+            conn.execute("DELETE FROM pending_highlights WHERE book = ? AND highlight = ?", (book, highlight))
+
+    def is_processed_highlight(self, book, highlight):
+        return bool(self._query("SELECT 1 FROM processed_highlights WHERE book = ? AND highlight = ?", (book, highlight)))
+
+    def processed_highlights(self, book):
+        """
+        Returns the {"highlight", "page_number"} entries of the highlights of a book that were processed with their
+        page number, leaving out the duplicates linked to another highlight, in the order they were processed.
+        """
+        rows = self._query(
+            "SELECT p.highlight, p.page_number FROM processed_highlights p "
+            "LEFT JOIN highlight_duplicates d ON d.book = p.book AND d.highlight = p.highlight "
+            "WHERE p.book = ? AND p.page_number IS NOT NULL AND d.highlight IS NULL ORDER BY p.rowid",
+            (book,)
+        )
+        return [{"highlight": highlight, "page_number": page_number} for highlight, page_number in rows]
+
+    # Highlights that are the same passage as another (canonical) highlight of the book
+    def link_duplicate_highlights(self, book, canonical, duplicates):
+        """Links duplicates to their canonical highlight and marks them processed; they share its context and QA pairs."""
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO highlight_duplicates (book, highlight, canonical) VALUES (?, ?, ?) "
+                "ON CONFLICT (book, highlight) DO UPDATE SET canonical = excluded.canonical",
+                [(book, duplicate, canonical) for duplicate in duplicates]
+            )
+            # a canonical highlight that became a duplicate hands over its own duplicates
+            conn.executemany(
+                "UPDATE highlight_duplicates SET canonical = ? WHERE book = ? AND canonical = ?",
+                [(canonical, book, duplicate) for duplicate in duplicates]
+            )
+            conn.executemany("INSERT OR IGNORE INTO processed_highlights (book, highlight) VALUES (?, ?)", [(book, duplicate) for duplicate in duplicates])
+            conn.executemany("DELETE FROM pending_highlights WHERE book = ? AND highlight = ?", [(book, duplicate) for duplicate in duplicates])
+
+    # Highlights read from the clippings file that could not be processed yet (eg: their book has no file)
+    def add_pending_highlights(self, book_name, entries):
+        """Keeps {"highlight", "page_number"} entries of a book for later runs, until they are processed."""
+        book = book_name.lstrip('\ufeff')
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO pending_highlights (book, highlight, book_name, page_number) VALUES (?, ?, ?, ?)",
+                [(book, entry["highlight"], book_name, entry["page_number"]) for entry in entries]
+            )
+
+    def pending_highlights(self):
+        """Returns {book name: [{"highlight", "page_number"}, ...]} of the pending highlights, in the order they were added."""
+        highlights = {}
+        for book_name, highlight, page_number in self._query("SELECT book_name, highlight, page_number FROM pending_highlights ORDER BY rowid"):
+            highlights.setdefault(book_name, []).append({"highlight": highlight, "page_number": page_number})
+        return highlights
+
+    # Book files whose highlights could not be extracted (eg: a broken pdf), by the size and mtime they had then
+    def record_failed_book(self, path):
+        stat = os.stat(path)
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO failed_books (path, size, mtime_ns, failed_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (path) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns, failed_at = excluded.failed_at",
+                (path, stat.st_size, stat.st_mtime_ns, datetime.now().strftime(SENT_AT_FORMAT))
+            )
+
+    def is_failed_book(self, path):
+        """Whether extracting the highlights of a book file failed before and the file did not change since."""
+        rows = self._query("SELECT size, mtime_ns FROM failed_books WHERE path = ?", (path,))
+        if not rows:
+            return False
+        stat = os.stat(path)
+        return rows[0] == (stat.st_size, stat.st_mtime_ns)
+
+    def clear_failed_book(self, path):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM failed_books WHERE path = ?", (path,))
+
+    # Cleaned contexts around highlights
+    def get_context(self, highlight):
+        rows = self._query("SELECT context FROM highlight_contexts WHERE highlight = ?", (highlight,))
+        return rows[0][0] if rows else None
+
+    def set_context(self, highlight, context):
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO highlight_contexts (highlight, context) VALUES (?, ?) "
+                "ON CONFLICT (highlight) DO UPDATE SET context = excluded.context",
+                (highlight, context)
+            )
+
+    # QA pairs generated from kindle highlights
+    def highlights_without_qa(self):
+        """Returns the (highlight, context) pairs no QA pairs were generated for yet, in the order they were added."""
+        return self._query(
+            "SELECT c.highlight, c.context FROM highlight_contexts c "
+            "LEFT JOIN highlight_qa_pairs q ON q.highlight = c.highlight "
+            "WHERE q.highlight IS NULL ORDER BY c.rowid"
+        )
+
+    def set_highlight_qa(self, highlight, qa):
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO highlight_qa_pairs (highlight, qa) VALUES (?, ?) "
+                "ON CONFLICT (highlight) DO UPDATE SET qa = excluded.qa",
+                (highlight, qa)
+            )
+
+    # QA pairs of question sets
+    def upsert_qa_pairs(self, question_set, qa_pairs):
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO qa_pairs (question_set, question, answer) VALUES (?, ?, ?) "
+                "ON CONFLICT (question_set, question) DO UPDATE SET answer = excluded.answer",
+                [(question_set, question, answer) for question, answer in qa_pairs.items()]
+            )
+
+    def qa_pairs(self, question_set):
+        """Returns the {question: answer} dict of a question set, in the order the questions were added."""
+        rows = self._query("SELECT question, answer FROM qa_pairs WHERE question_set = ? ORDER BY rowid", (question_set,))
+        return dict(rows)
+
+    # When questions were last sent
+    def record_sent(self, question_set, questions, sent_at=None):
+        sent_at = sent_at or datetime.now().strftime(SENT_AT_FORMAT)
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO send_history (question_set, question, sent_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (question_set, question) DO UPDATE SET sent_at = excluded.sent_at",
+                [(question_set, question, sent_at) for question in questions]
+            )
+
+    def send_history(self, question_set):
+        """Returns {question: last time it was sent} for a question set."""
+        return dict(self._query("SELECT question, sent_at FROM send_history WHERE question_set = ?", (question_set,)))
+
+    # Jobs of the OpenAI batch mode
+    def add_batch_job(self, job_id, kind, requests_file, requests):
+        """Records a batch job before it is submitted. requests are (custom_id, highlight, book) tuples."""
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO batch_jobs (job_id, kind, requests_file, status, created_at) VALUES (?, ?, ?, 'prepared', ?)",
+                (job_id, kind, requests_file, datetime.now().strftime(SENT_AT_FORMAT))
+            )
+            conn.executemany(
+                "INSERT INTO batch_requests (job_id, custom_id, highlight, book) VALUES (?, ?, ?, ?)",
+                [(job_id, *request) for request in requests]
+            )
+
+    def update_batch_job(self, job_id, **fields):
+        columns = ", ".join(f"{column} = ?" for column in fields)
+        with self.transaction() as conn:
+            conn.execute(f"UPDATE batch_jobs SET {columns} WHERE job_id = ?", (*fields.values(), job_id))
+
+    def open_batch_jobs(self):
+        """Returns the batch jobs whose results were not merged yet, as dicts."""
+        with self._lock:
+            cursor = self._conn.execute("SELECT * FROM batch_jobs WHERE merged_at IS NULL ORDER BY created_at")
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def batch_requests(self, job_id):
+        """Returns {custom_id: (highlight, book)} of a batch job."""
+        rows = self._query("SELECT custom_id, highlight, book FROM batch_requests WHERE job_id = ?", (job_id,))
+        return {custom_id: (highlight, book) for custom_id, highlight, book in rows}
+
+    def highlights_in_open_batches(self, kind):
+        """Returns the highlights that are part of a batch job of the given kind that was not merged yet."""
+        rows = self._query(
+            "SELECT r.highlight FROM batch_requests r JOIN batch_jobs j ON j.job_id = r.job_id "
+            "WHERE j.kind = ? AND j.merged_at IS NULL", (kind,)
+        )
+        return {row[0] for row in rows}
+
+    # Files and folders of the obsidian vault on google drive, as of the last sync
+    def drive_files(self):
+        """Returns {id: file} of every cached file and folder of the vault."""
+        return {file_id: json.loads(file) for file_id, file in self._query("SELECT file_id, file FROM drive_files")}
+
+    def replace_drive_files(self, files):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM drive_files")
+            conn.executemany("INSERT INTO drive_files (file_id, file) VALUES (?, ?)", [(file_id, json.dumps(file)) for file_id, file in files.items()])
+
+    def update_drive_files(self, files, removed_ids):
+        """Upserts the given {id: file} and deletes the removed ones, in one transaction."""
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO drive_files (file_id, file) VALUES (?, ?) ON CONFLICT (file_id) DO UPDATE SET file = excluded.file",
+                [(file_id, json.dumps(file)) for file_id, file in files.items()]
+            )
+            conn.executemany("DELETE FROM drive_files WHERE file_id = ?", [(file_id,) for file_id in removed_ids])
+
+    # What every note of the vault looked like when QA pairs were last generated from it
+    def drive_manifest_entry(self, file_id):
+        rows = self._query("SELECT path, md5_checksum, modified_time, content_hash FROM drive_manifest WHERE file_id = ?", (file_id,))
+        if not rows:
+            return None
+        path, md5_checksum, modified_time, content_hash = rows[0]
+        return {"path": path, "md5_checksum": md5_checksum, "modified_time": modified_time, "content_hash": content_hash}
+
+    def set_drive_manifest_entry(self, file_id, path, md5_checksum, modified_time, content_hash):
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO drive_manifest (file_id, path, md5_checksum, modified_time, content_hash, processed_at) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (file_id) DO UPDATE SET path = excluded.path, md5_checksum = excluded.md5_checksum, "
+                "modified_time = excluded.modified_time, content_hash = excluded.content_hash, processed_at = excluded.processed_at",
+                (file_id, path, md5_checksum, modified_time, content_hash, datetime.now().strftime(SENT_AT_FORMAT))
+            )
+
+    # Migration from the json files the pipelines used before
+    def _json_file_changed(self, path):
+        """Returns the (size, mtime) of a json file if it exists and was not imported in this exact version yet."""
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        rows = self._query("SELECT size, mtime_ns FROM imported_files WHERE path = ?", (os.path.abspath(path),))
+        if rows and rows[0] == (stat.st_size, stat.st_mtime_ns):
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def _mark_json_file_imported(self, conn, path, version):
+        conn.execute(
+            "INSERT INTO imported_files (path, size, mtime_ns) VALUES (?, ?, ?) "
+            "ON CONFLICT (path) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns",
+            (os.path.abspath(path), *version)
+        )
+
+    def _import_json_file(self, path, import_data):
+        version = self._json_file_changed(path)
+        if version is None:
+            return False
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except json.JSONDecodeError:
+            print(f"Error reading {path}. File might be corrupted. Not importing it.")
+            return False
+        with self.transaction() as conn:
+            import_data(conn, data)
+            self._mark_json_file_imported(conn, path, version)
+        print(f"Imported {path} into {self.path}")
+        return True
+
+    def import_qa_pairs_file(self, question_set, path):
+        """
+        Imports the generated_qa_pairs.json of a question set. Files are only (re)imported when they
+        changed since the last import, so question sets can still be edited by hand.
+        """
+        def import_data(conn, data):
+            conn.executemany(
+                "INSERT INTO qa_pairs (question_set, question, answer) VALUES (?, ?, ?) "
+                "ON CONFLICT (question_set, question) DO UPDATE SET answer = excluded.answer",
+                [(question_set, question, answer) for question, answer in data.items()]
+            )
+        return self._import_json_file(path, import_data)
+
+    def import_send_history_file(self, question_set, path):
+        def import_data(conn, data):
+            conn.executemany(
+                "INSERT INTO send_history (question_set, question, sent_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (question_set, question) DO UPDATE SET sent_at = max(sent_at, excluded.sent_at)",
+                [(question_set, question, sent_at) for question, sent_at in data.items()]
+            )
+        return self._import_json_file(path, import_data)
+
+    def migrate_json_state(self):
+        """Imports the json files the pipelines kept their state in before this store existed."""
+        def import_contexts(conn, data):
+            conn.executemany("INSERT OR IGNORE INTO highlight_contexts (highlight, context) VALUES (?, ?)", data.items())
+
+        def import_processed_highlights(conn, data):
+            conn.executemany(
+                "INSERT OR IGNORE INTO processed_highlights (book, highlight) VALUES (?, ?)",
+                [(book, highlight) for book, highlights in data.items() for highlight in highlights]
+            )
+
+        def import_highlight_qa_pairs(conn, data):
+            conn.executemany("INSERT OR IGNORE INTO highlight_qa_pairs (highlight, qa) VALUES (?, ?)", data.items())
+
+        self._import_json_file(CACHE_FILE, import_contexts)
+        self._import_json_file(PROCESSED_HIGHLIGHTS_FILE, import_processed_highlights)
+        self._import_json_file(QUESTION_ANSWER_PAIRS_FILE, import_highlight_qa_pairs)
+
+        if os.path.isdir(QUESTION_SETS_DIR):
+            for set_dir in os.listdir(QUESTION_SETS_DIR):
+                set_path = os.path.join(QUESTION_SETS_DIR, set_dir)
+                if not os.path.isdir(set_path):
+                    continue
+                # QA pairs are stored under the set's directory name (like the drive sync saves them),
+                # the send history under the set's internal name (like the emailer used to)
+                qa_pairs_file, internal_name = question_set_files(set_path, set_dir)
+                self.import_qa_pairs_file(set_dir, qa_pairs_file)
+                self.import_send_history_file(internal_name, f"{PROCESSED_TEXT_FILE}_{internal_name}.json")
+
+
+def question_set_files(set_path, set_dir):
+    """Returns the path of the QA pairs json file and the internal name of a question set directory."""
+    config_path = os.path.join(set_path, "config.json")
+    if os.path.exists(config_path):
+        with open(config_path, 'r') as config_file:
+            config = json.load(config_file)
+        return os.path.join(set_path, config.get("qa_pairs_file", "generated_qa_pairs.json")), config.get("internal_name", set_dir)
+    return os.path.join(set_path, "generated_qa_pairs.json"), set_dir
+
+
+_state_store = None
+_state_store_lock = threading.Lock()
+
+
+def get_state_store():
+    """Returns the state store of this process, opening it (and importing old json state) on first use."""
+    global _state_store
+    with _state_store_lock:
+        if _state_store is None:
+            _state_store = StateStore(STATE_DB_FILE)
+            _state_store.migrate_json_state()
+        return _state_store